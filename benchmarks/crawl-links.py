@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+#
+# Micro-benchmark of the extraction of links in bitextor-crawl:
+# 1. It reads a WARC file with saved pages, for example the output of bitextor-crawl
+# 2. Links are extracted from every page and resolved as bitextor-crawl does
+#    before adding them to the frontier, both with the previous implementation
+#    (decoding of the whole page and uncompiled regular expressions) and with
+#    the current one
+# 3. The number of links processed per second by each of them is printed
+#
+
+import os
+import re
+import sys
+import time
+import random
+import argparse
+import warc
+
+from posixpath import join, dirname, normpath
+from urllib.parse import quote
+
+def load_crawler():
+  # Only the classes are loaded, leaving out the command-line handling of the script
+  path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bitextor-crawl.py")
+  source = open(path).read()
+  namespace = {"__name__": "bitextor_crawl"}
+  exec(compile(source[:source.index("##### NEW CODE #####")], path, "exec"), namespace)
+  return namespace["Crawler"]
+
+def previous_extract_links(text):
+  try:
+    links = re.findall("href\s*=\s*['\"]\s*([^'\"]+)['\"]", text.decode('utf8'))
+  except:
+    links = re.findall("href\s*=\s*['\"]\s*([^'\"]+)['\"]", text.decode('latin1'))
+  linksset = list(set(links))
+  random.shuffle(linksset)
+  return linksset
+
+def previous_follow_link(crawler, url, link):
+  if len(link) > 2000:
+    return None
+  link = re.sub(r'#[^#]*$', '', link)
+  if re.search(crawler.prefix_filter, link):
+    return None
+  for f in crawler.url_filters:
+    if re.search(f, link):
+      return None
+  rx = re.match('(https?://)([^/:]+)(:[0-9]+)?([^\?]*)(\?.*)?', url)
+  url_proto = rx.group(1)
+  url_host = rx.group(2)
+  url_port = rx.group(3) if rx.group(3) else ''
+  url_path = rx.group(4) if len(rx.group(4)) > 0 else '/'
+  url_dir_path = dirname(url_path)
+  rx = re.match('((https?://)([^/:]+)(:[0-9]+)?)?([^\?]*)(\?.*)?', link)
+  link_full_url = rx.group(1) != None
+  link_proto = rx.group(2) if rx.group(2) else url_proto
+  link_host = rx.group(3) if rx.group(3) else url_host
+  link_port = rx.group(4) if rx.group(4) else url_port
+  link_path = rx.group(5) if rx.group(5) else url_path
+  link_query = quote(rx.group(6), '?=&%') if rx.group(6) else ''
+  if not link_full_url and not link.startswith('/'):
+    link_path = normpath(join(url_dir_path, link_path))
+  link_url = link_proto + link_host + link_port + link_path + link_query
+  return link_url if crawler._url_domain(crawler.host) == crawler._url_domain(link_host) else None
+
+def run_previous(crawler, pages):
+  nlinks = 0
+  for url, text in pages:
+    for link in previous_extract_links(text):
+      previous_follow_link(crawler, url, link.strip())
+      nlinks += 1
+  return nlinks
+
+def run_current(crawler, pages):
+  nlinks = 0
+  for url, text in pages:
+    doc = Page(url, text)
+    base = crawler._url_base(url)
+    for link in crawler._extract_links(doc):
+      crawler._follow_link(url, link, base)
+      nlinks += 1
+  return nlinks
+
+class Page(object):
+  def __init__(self, url, text):
+    self.url = url
+    self.text = text
+
+oparser = argparse.ArgumentParser(description="Micro-benchmark that measures the number of links per second extracted and resolved by bitextor-crawl on the pages saved in a WARC file.")
+oparser.add_argument("warc", metavar="WARC", help="WARC file with the pages, such as the output of bitextor-crawl")
+oparser.add_argument("-r", "--repeat", help="Number of times the pages are processed by each implementation", dest="repeat", type=int, default=5)
+oparser.add_argument("-f", "--filter", help="URL filter (regular expression) added to the crawler; it can be repeated", dest="filters", action="append", default=[])
+options = oparser.parse_args()
+
+pages = []
+for record in warc.WARCFile(filename=options.warc):
+  if record.url != None:
+    pages.append((record.url, record.payload.read()))
+if not pages:
+  sys.stderr.write("No pages found in "+options.warc+"\n")
+  sys.exit(1)
+
+Crawler = load_crawler()
+crawler = Crawler()
+crawler.set_follow_mode(Crawler.F_SAME_DOMAIN)
+crawler.host = re.match('https?://([^/]+)', pages[0][0]).group(1)
+crawler.currdomain = crawler._url_domain(crawler.host)
+for f in options.filters:
+  crawler.add_url_filter(f)
+
+sys.stderr.write("{0} pages, {1:.1f} MB\n".format(len(pages), sum(len(text) for _, text in pages)/1000000.0))
+for name, run in (("previous", run_previous), ("current", run_current)):
+  best = None
+  for _ in range(options.repeat):
+    start = time.perf_counter()
+    nlinks = run(crawler, pages)
+    elapsed = time.perf_counter() - start
+    best = elapsed if best is None else min(best, elapsed)
+  print("{0}\t{1} links\t{2:.0f} links/s".format(name, nlinks, nlinks/best))
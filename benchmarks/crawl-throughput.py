@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+#
+# Throughput benchmark of bitextor-crawl, which works offline:
+# 1. A local HTTP server is started with a synthetic bilingual website: every
+#    page has a translation in the other language (linked with hreflang), a
+#    number of links to other pages of the same language, some of them through
+#    chains of redirects, and a share of the pages return an error
+# 2. bitextor-crawl is run on that website with every combination of the
+#    values given for -j and -T
+# 3. For every run, the number of pages and requests, the pages and bytes
+#    downloaded per second, the CPU time used per page and the peak memory (RSS)
+#    of the crawler are printed
+#
+# The options after -- are passed to bitextor-crawl, for example:
+#   crawl-throughput.py -j 8,32 -T 0 -- --async --autothrottle
+#
+
+import os
+import re
+import sys
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+import http.server
+import warc
+
+class SiteHandler(http.server.BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+
+  def log_message(self, format, *args):
+    pass
+
+  def send(self, status, body=b"", content_type="text/html; charset=utf-8", headers=()):
+    self.send_response(status)
+    self.send_header("Content-Type", content_type)
+    self.send_header("Content-Length", str(len(body)))
+    for name, value in headers:
+      self.send_header(name, value)
+    self.end_headers()
+    self.wfile.write(body)
+    with served.get_lock():
+      served.value += 1
+    with sent.get_lock():
+      sent.value += len(body)
+
+  def do_GET(self):
+    time.sleep(options.latency)
+    if self.path == "/robots.txt":
+      self.send(200, b"User-agent: *\nDisallow:\n", "text/plain")
+      return
+    if self.path == "/":
+      self.send(200, page(options.langs[0], 0, random.Random(self.path)))
+      return
+    rx = re.match(r"/r/([0-9]+)(/.*)$", self.path)
+    if rx:
+      # Every step of a redirect chain leads to the next one
+      steps = int(rx.group(1))
+      location = rx.group(2) if steps <= 1 else "/r/"+str(steps-1)+rx.group(2)
+      self.send(301, headers=[("Location", location)])
+      return
+    rx = re.match(r"/([a-z]+)/([0-9]+)\.html$", self.path)
+    if rx is None or rx.group(1) not in options.langs or int(rx.group(2)) >= options.pages:
+      self.send(404, b"<html><body>Not found</body></html>")
+      return
+    r = random.Random(self.path)
+    if r.random() < options.error_rate:
+      self.send(500, b"<html><body>Internal server error</body></html>")
+      return
+    self.send(200, page(rx.group(1), int(rx.group(2)), r))
+
+def words(lang):
+  # A made-up vocabulary for every language, so the text of the translations differs
+  r = random.Random(lang)
+  syllables = ["".join(r.choice("bcdfglmnprstv")+r.choice("aeiou") for _ in range(2)) for _ in range(40)]
+  return ["".join(r.choice(syllables) for _ in range(r.randint(1, 3))) for _ in range(2000)]
+
+def page(lang, number, r):
+  links = ['<a href="/{0}/{1}.html">next</a>'.format(lang, (number+1) % options.pages)]
+  for _ in range(options.fanout):
+    target = "/{0}/{1}.html".format(lang, r.randrange(options.pages))
+    if r.random() < options.redirect_rate:
+      target = "/r/"+str(options.redirects)+target
+    links.append('<a href="{0}">{1}</a>'.format(target, r.choice(vocabulary[lang])))
+  alternates = "".join('<link rel="alternate" hreflang="{0}" href="/{0}/{1}.html">'.format(other, number) for other in options.langs if other != lang)
+  alternates += "".join('<a href="/{0}/{1}.html">{0}</a>'.format(other, number) for other in options.langs if other != lang)
+  # The text is the same for a page and its translations, word by word
+  text = random.Random(number)
+  paragraphs = []
+  size = 0
+  while size < options.page_size:
+    paragraph = " ".join(vocabulary[lang][text.randrange(len(vocabulary[lang]))] for _ in range(text.randint(20, 80)))
+    paragraphs.append("<p>"+paragraph+"</p>")
+    size += len(paragraph)+7
+  return ('<html lang="{0}"><head><title>{0} {1}</title>{2}</head><body>{3}{4}</body></html>'.format(
+    lang, number, alternates, "".join(paragraphs), " ".join(links))).encode("utf-8")
+
+def count_pages(path):
+  pages = 0
+  for record in warc.WARCFile(filename=path):
+    if record.type == "response":
+      pages += 1
+  return pages
+
+def run_crawler(url, jobs, delay):
+  crawler = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bitextor-crawl.py")
+  command = [sys.executable, crawler, "-j", str(jobs), "-T", str(delay)] + options.crawler_args + [url]
+  with served.get_lock():
+    served.value = 0
+  with sent.get_lock():
+    sent.value = 0
+  with tempfile.NamedTemporaryFile(suffix=".warc") as output:
+    log = open(options.log, "a") if options.log != None else subprocess.DEVNULL
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=output, stderr=log)
+    # wait4 gives the CPU time and the peak RSS of the crawler alone
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if log != subprocess.DEVNULL:
+      log.close()
+    if process.returncode != 0:
+      sys.stderr.write("bitextor-crawl ended with status "+str(process.returncode)+": "+" ".join(command)+"\n")
+    pages = count_pages(output.name)
+  return pages, served.value, sent.value, elapsed, usage.ru_utime+usage.ru_stime, usage.ru_maxrss/1000.0
+
+def numbers(value, kind):
+  return [kind(v) for v in value.split(",")]
+
+oparser = argparse.ArgumentParser(description="Benchmark that runs bitextor-crawl on a synthetic bilingual website served locally and measures its throughput for several values of -j and -T.")
+oparser.add_argument("-j", "--jobs", help="Comma-separated values of option -j of bitextor-crawl; by default 1,8,32", dest="jobs", type=lambda v: numbers(v, int), default=[1, 8, 32])
+oparser.add_argument("-T", "--delay", help="Comma-separated values of option -T of bitextor-crawl; by default 0", dest="delay", type=lambda v: numbers(v, float), default=[0.0])
+oparser.add_argument("-p", "--pages", help="Number of pages of the website in every language; by default 500", dest="pages", type=int, default=500)
+oparser.add_argument("--langs", help="Comma-separated languages of the website; by default en,fr", dest="langs", type=lambda v: v.split(","), default=["en", "fr"])
+oparser.add_argument("--page-size", help="Approximate size of the text of a page in bytes; by default 5000", dest="page_size", type=int, default=5000)
+oparser.add_argument("--fanout", help="Number of links to other pages of the same language in every page; by default 10", dest="fanout", type=int, default=10)
+oparser.add_argument("--latency", help="Time the server takes to answer every request, in seconds; by default 0.02", dest="latency", type=float, default=0.02)
+oparser.add_argument("--error-rate", help="Share of the pages that return a 500 error; by default 0.02", dest="error_rate", type=float, default=0.02)
+oparser.add_argument("--redirect-rate", help="Share of the links that go through a chain of redirects; by default 0.05", dest="redirect_rate", type=float, default=0.05)
+oparser.add_argument("--redirects", help="Length of the chains of redirects; by default 3", dest="redirects", type=int, default=3)
+oparser.add_argument("-r", "--repeat", help="Number of times every setting is run; the fastest run is reported", dest="repeat", type=int, default=1)
+oparser.add_argument("--log", help="File where the standard error of bitextor-crawl is appended; by default it is discarded", dest="log", default=None)
+oparser.add_argument("crawler_args", metavar="-- OPTIONS", nargs=argparse.REMAINDER, help="Options passed to bitextor-crawl")
+options = oparser.parse_args()
+if options.crawler_args[:1] == ["--"]:
+  options.crawler_args = options.crawler_args[1:]
+
+vocabulary = {lang: words(lang) for lang in options.langs}
+served = multiprocessing.Value("q", 0)
+sent = multiprocessing.Value("q", 0)
+
+# The server runs in a process of its own, so it does not take CPU time from the benchmark
+server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), SiteHandler)
+server.daemon_threads = True
+url = "http://127.0.0.1:"+str(server.server_address[1])+"/"
+serverprocess = multiprocessing.get_context("fork").Process(target=server.serve_forever)
+serverprocess.daemon = True
+serverprocess.start()
+server.socket.close()
+
+sys.stderr.write("{0} pages in {1} languages served at {2}\n".format(options.pages*len(options.langs), len(options.langs), url))
+print("jobs\tdelay\tpages\trequests\tpages/s\tMB/s\tCPU ms/page\tpeak RSS MB")
+try:
+  for delay in options.delay:
+    for jobs in options.jobs:
+      best = None
+      for _ in range(options.repeat):
+        result = run_crawler(url, jobs, delay)
+        if best is None or result[3] < best[3]:
+          best = result
+      pages, requests, size, elapsed, cpu, rss = best
+      print("{0}\t{1:g}\t{2}\t{3}\t{4:.1f}\t{5:.2f}\t{6:.2f}\t{7:.1f}".format(jobs, delay, pages, requests,
+        pages/elapsed, size/1000000.0/elapsed, 1000.0*cpu/max(pages, 1), rss))
+      sys.stdout.flush()
+finally:
+  serverprocess.terminate()
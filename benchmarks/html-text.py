@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+#
+# Benchmark of the extraction of text and of the normalisation of the HTML of
+# bitextor-get-html-text, on saved pages:
+# 1. The pages are read from WARC files (for example, the output of
+#    bitextor-crawl) or from directories of HTML files, and decoded with the
+#    character encoding identified by libmagic, as bitextor-identifyMIME does
+# 2. Every mode is run on all the pages, in a single process and with a pool
+#    of every number of worker processes given with -j:
+#    - text-bs4: option --text before the lxml extractor, with BeautifulSoup
+#    - text: option --text, with the lxml extractor
+#    - xml-ftfy: option --xml running ftfy on every page
+#    - xml: option --xml, which skips ftfy on the pages it would not change
+# 3. For every run, the pages and MB of HTML processed per second are printed,
+#    and whether the output is the same as that of the previous mode (text-bs4
+#    or xml-ftfy)
+#
+
+import os
+import re
+import sys
+import time
+import argparse
+import multiprocessing
+import warc
+import ftfy
+import html5lib
+from lxml import etree
+from lxml.html.clean import Cleaner
+from bs4 import BeautifulSoup
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from lettprocessing import open_magic, identify_mime, clean_html, html_text, ordered_map
+
+def bs4_html_text(html):
+  soup = BeautifulSoup(html, "lxml")
+  for script in soup(["script", "style", "img"]):
+    script.extract()
+  text = soup.get_text()
+  return re.sub(r"\n+","\n",re.sub(r" *\n *","\n",re.sub(r" +"," ",re.sub(r"\r","", text))))
+
+def ftfy_clean_html(html):
+  document = html5lib.parse(ftfy.fix_text(Cleaner(style=True, links=True, add_nofollow=True,page_structure=False, safe_attrs_only=False).clean_html(html)),treebuilder="lxml",namespaceHTMLElements=False)
+  return etree.tostring(document).decode("utf8").replace("\t"," ")
+
+# Mode, function and mode whose output it must match
+MODES = [("text-bs4", bs4_html_text, None), ("text", html_text, "text-bs4"), ("xml-ftfy", ftfy_clean_html, None), ("xml", clean_html, "xml-ftfy")]
+
+def contents(path):
+  if os.path.isdir(path):
+    for directory, subdirectories, files in os.walk(path):
+      subdirectories.sort()
+      for name in sorted(files):
+        with open(os.path.join(directory, name), "rb") as page:
+          yield page.read()
+  else:
+    for record in warc.WARCFile(filename=path):
+      if record.type == "response":
+        yield record.payload.read()
+
+def read_pages(paths):
+  m = open_magic()
+  pages = []
+  for path in paths:
+    for content in contents(path):
+      if len(pages) == options.max_pages:
+        return pages
+      try:
+        magicoutput, text = identify_mime(m, content)
+      except (LookupError, UnicodeDecodeError):
+        continue
+      if magicoutput[0] == "text/html":
+        pages.append(text)
+  return pages
+
+def run_mode(function, pages, jobs):
+  start = time.perf_counter()
+  if jobs > 1:
+    pool = multiprocessing.get_context("fork").Pool(jobs)
+    try:
+      output = list(ordered_map(pool, function, pages, jobs))
+    finally:
+      pool.terminate()
+  else:
+    output = [function(page) for page in pages]
+  return time.perf_counter() - start, output
+
+oparser = argparse.ArgumentParser(description="Benchmark that measures the pages per second of the modes of bitextor-get-html-text, before and after the lxml text extractor and the ftfy check, on saved pages.")
+oparser.add_argument("pages", metavar="PATH", nargs="+", help="WARC files or directories of HTML files with the pages")
+oparser.add_argument("-j", "--jobs", help="Comma-separated numbers of worker processes; by default 1 and the number of CPUs", dest="jobs", type=lambda v: [int(j) for j in v.split(",")], default=sorted({1, multiprocessing.cpu_count()}))
+oparser.add_argument("-m", "--modes", help="Comma-separated modes to run; by default all of them: "+",".join(mode for mode, function, reference in MODES), dest="modes", type=lambda v: v.split(","), default=[mode for mode, function, reference in MODES])
+oparser.add_argument("-n", "--max-pages", help="Maximum number of pages read; by default, all of them", dest="max_pages", type=int, default=None)
+oparser.add_argument("-r", "--repeat", help="Number of times every setting is run; the fastest run is reported", dest="repeat", type=int, default=1)
+options = oparser.parse_args()
+
+pages = read_pages(options.pages)
+size = sum(len(page.encode("utf-8")) for page in pages)
+sys.stderr.write("{0} HTML pages read, {1:.1f} MB\n".format(len(pages), size/1000000.0))
+print("mode\tjobs\tpages\tpages/s\tMB/s\tsame output")
+outputs = {}
+for mode, function, reference in MODES:
+  if mode not in options.modes:
+    continue
+  for jobs in options.jobs:
+    best = None
+    for _ in range(options.repeat):
+      elapsed, output = run_mode(function, pages, jobs)
+      if best is None or elapsed < best:
+        best = elapsed
+    outputs.setdefault(mode, output)
+    same = "-" if reference not in outputs else ("yes" if output == outputs[reference] else "no")
+    print("{0}\t{1}\t{2}\t{3:.1f}\t{4:.2f}\t{5}".format(mode, jobs, len(pages), len(pages)/best, size/1000000.0/best, same))
+    sys.stdout.flush()
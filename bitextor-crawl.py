@@ -10,16 +10,36 @@
 # and a nubmer of optional parameters (use option -h for more details).
 # The output is a WARC file
 
+import asyncio
+import bisect
+import datetime
+import email.utils
+import gzip
+import hashlib
+import heapq
 import http.client
+import http.server
+import io
+import json
 import logging
+import math
+import multiprocessing
+import os
+import queue
 import re
+import socket
+import ssl
 import sys
 import time
 import urllib.robotparser
+import zlib
+import xml.etree.ElementTree as ElementTree
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from ssl import CertificateError
 from posixpath import join, dirname, normpath
-from threading import Thread, Lock
+from threading import Thread, Lock, RLock, Event, Condition
 from urllib.parse import quote, unquote
 
 import urllib.request, urllib.error, urllib.parse
@@ -33,29 +53,1577 @@ import random
 
 import signal
 import pickle
+import sqlite3
 import warc
 import time
 
+try:
+    import brotli
+    # Versions before 1.1 cannot limit the output, so they would inflate a
+    # compression bomb as a whole; br is not used with them
+    brotli.Decompressor().process(b'', output_buffer_limit=1)
+except (ImportError, TypeError, AttributeError):
+    brotli = None
+
+# Patterns used to extract the links of the documents and to resolve them
+HREF_RX = re.compile(rb"href\s*=\s*['\"]\s*([^'\"]+)['\"]")
+ANCHOR_RX = re.compile(r'#[^#]*$')
+URL_RX = re.compile('(https?://)([^/:]+)(:[0-9]+)?([^\?]*)(\?.*)?')
+LINK_RX = re.compile('((https?://)([^/:]+)(:[0-9]+)?)?([^\?]*)(\?.*)?')
+IP_RX = re.compile('^[0-9]+(?:\.[0-9]+){3}$')
+# Tags with the links to the versions of a page in other languages
+HREFLANG_RX = re.compile(rb"<(?:link|a)\s[^>]*\bhreflang\s*=\s*['\"]?([A-Za-z_-]+)[^>]*>", re.I)
+TAG_HREF_RX = re.compile(rb"\bhref\s*=\s*['\"]\s*([^'\"]+)['\"]", re.I)
+
+class DocumentTooLarge(Exception):
+    """Raised when the body of a response is longer than the maximum size
+    allowed for a document; size is the number of bytes read until then.
+    """
+    def __init__(self, size):
+        Exception.__init__(self, "document larger than the maximum size allowed")
+        self.size = size
+
+class BodyDecoder(object):
+    """Streaming decompression of a response body sent with a
+    Content-Encoding: gzip, deflate and, if the brotli module (1.1 or later)
+    is installed, br. The body is returned as it is for any other encoding.
+    The output is cut a byte after limit, which is enough to tell the
+    document is too large without inflating a compression bomb.
+    """
+    errors = (zlib.error,) if brotli is None else (zlib.error, brotli.error)
+
+    def __init__(self, encoding, limit=None):
+        self.encoding = (encoding or '').strip().lower()
+        self.limit = limit
+        self.size = 0
+        if self.encoding in ('gzip', 'x-gzip'):
+            self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == 'deflate':
+            self.decoder = zlib.decompressobj()
+        elif self.encoding == 'br' and brotli is not None:
+            self.decoder = brotli.Decompressor()
+        else:
+            self.decoder = None
+        self.started = False
+
+    @staticmethod
+    def accept_encoding():
+        return 'gzip, deflate, br' if brotli is not None else 'gzip, deflate'
+
+    def _decompress(self, data):
+        if self.encoding == 'br':
+            if self.limit is None:
+                return self.decoder.process(data)
+            return self.decoder.process(data, output_buffer_limit=max(self.limit - self.size + 1, 1))
+        if self.limit is None:
+            return self.decoder.decompress(data)
+        return self.decoder.decompress(data, max(self.limit - self.size + 1, 1))
+
+    def decompress(self, data):
+        """Returns the decompressed data of the chunk of the body given;
+        HTTPException is raised if the body is not valid.
+        """
+        if self.decoder is None:
+            self.size += len(data)
+            return data
+        try:
+            try:
+                output = self._decompress(data)
+            except zlib.error:
+                # Some servers send a raw deflate stream, without the zlib header
+                if self.encoding != 'deflate' or self.started:
+                    raise
+                self.decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+                output = self._decompress(data)
+        except self.errors as e:
+            raise http.client.HTTPException("invalid %s content: %s" % (self.encoding, e))
+        self.started = True
+        self.size += len(output)
+        return output
+
+    def flush(self):
+        if self.decoder is None or self.encoding == 'br':
+            return b''
+        output = self.decoder.flush()
+        self.size += len(output)
+        return output
+
 class Document(object):
-    def __init__(self, res, url):
+    def __init__(self, res, url, text=None):
         self.url = url
         self.query = '' if not '?' in url else url.split('?')[-1]
         self.status = res.status
-        self.text = res.read()
+        self.text = res.read() if text is None else text
 
         self.headers = dict(res.getheaders())
         self.links = []
 
+class BloomFilter(object):
+    """Scalable Bloom filter (Almeida et al., 2007) used as a compact set of
+    URLs: membership tests can give false positives, at most with probability
+    error_rate, but never false negatives. Every time a filter is full a new
+    one, larger and with a lower error rate, is added, so the number of URLs
+    does not need to be known in advance.
+    """
+    def __init__(self, error_rate=0.0001, capacity=100000, growth=4, ratio=0.85):
+        self.error_rate = error_rate
+        self.capacity = capacity
+        self.growth = growth
+        self.ratio = ratio
+        # Every filter is a list [bits, number of bits, number of hashes, capacity, count]
+        self.filters = []
+        self.count = 0
+
+    def _hashes(self, item):
+        digest = hashlib.blake2b(item.encode('utf8', 'surrogatepass'), digest_size=16).digest()
+        return int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+
+    def _new_filter(self):
+        n = len(self.filters)
+        capacity = self.capacity * self.growth ** n
+        # Error rates of the filters follow a geometric series that adds up to error_rate
+        error = self.error_rate * (1 - self.ratio) * self.ratio ** n
+        nbits = int(math.ceil(capacity * -math.log(error) / math.log(2) ** 2))
+        nhashes = int(math.ceil(-math.log(error, 2)))
+        self.filters.append([bytearray((nbits + 7) // 8), nbits, nhashes, capacity, 0])
+
+    def _contains(self, h1, h2):
+        for bits, nbits, nhashes, _, _ in self.filters:
+            for i in range(nhashes):
+                pos = (h1 + i * h2) % nbits
+                if not bits[pos >> 3] & (1 << (pos & 7)):
+                    break
+            else:
+                return True
+        return False
+
+    def __contains__(self, item):
+        return self._contains(*self._hashes(item))
+
+    def __len__(self):
+        return self.count
+
+    def add(self, item):
+        h1, h2 = self._hashes(item)
+        if self._contains(h1, h2):
+            return False
+        if not self.filters or self.filters[-1][4] >= self.filters[-1][3]:
+            self._new_filter()
+        f = self.filters[-1]
+        bits, nbits, nhashes = f[0], f[1], f[2]
+        for i in range(nhashes):
+            pos = (h1 + i * h2) % nbits
+            bits[pos >> 3] |= 1 << (pos & 7)
+        f[4] += 1
+        self.count += 1
+        return True
+
+class MemoryFrontier(object):
+    """Crawl frontier kept in memory: a LIFO list with the URLs to be crawled,
+    the set of URLs already seen, the number of download attempts of every
+    visited URL and, in TLD mode, the URLs found for other domains.
+
+    If a key function is set, URLs are queued separately by its value (the
+    domain of the URL, when several domains are crawled at the same time) and
+    have to be popped from their own queue.
+
+    If prioritised is set, every queue is a heap instead of a LIFO list and
+    the URL with the highest priority is popped first; URLs with the same
+    priority are still popped in LIFO order.
+
+    If seen is a BloomFilter, visited URLs are only looked up in it and
+    visited just keeps the attempts of the URLs whose download failed, so the
+    memory used does not depend on the length of the URLs.
+    """
+    path = None
+
+    def __init__(self, seen=None):
+        self.targets = []
+        self.queues = {}
+        self.queued = 0
+        self.key = None
+        self.prioritised = False
+        self.sequence = 0
+        self.seen = set() if seen is None else seen
+        self.visited = {}
+        self.outerdomaintargets = {}
+
+    def __len__(self):
+        return len(self.targets) + self.queued
+
+    def _push(self, url, priority=0):
+        domain = self.key(url) if self.key is not None else None
+        if domain is None:
+            queue = self.targets
+        else:
+            queue = self.queues.setdefault(domain, [])
+            self.queued += 1
+        if self.prioritised:
+            self.sequence += 1
+            heapq.heappush(queue, (-priority, -self.sequence, url))
+        else:
+            queue.append(url)
+
+    def _pop(self, queue):
+        if self.prioritised:
+            return heapq.heappop(queue)[2]
+        return queue.pop()
+
+    @property
+    def compact(self):
+        return isinstance(self.seen, BloomFilter)
+
+    def add(self, url, priority=0):
+        if url in self.seen or url in self.visited:
+            return False
+        self._push(url, priority)
+        self.seen.add(url)
+        return True
+
+    def pop(self, domain=None):
+        if domain is None:
+            if not self.targets:
+                return None
+            url = self._pop(self.targets)
+        else:
+            queue = self.queues.get(domain)
+            if not queue:
+                return None
+            url = self._pop(queue)
+            self.queued -= 1
+            if not queue:
+                del self.queues[domain]
+        if not self.compact and url not in self.visited:
+            self.visited[url] = 1
+        return url
+
+    def retry(self, url, max_attempts=5, priority=0):
+        """Puts back in the frontier a URL whose download failed. Returns the
+        number of the failed attempt, or None if the URL has to be given up.
+        """
+        attempt = self.visited.get(url, 1)
+        if attempt > max_attempts:
+            if self.compact:
+                del self.visited[url]
+            return None
+        self._push(url, priority)
+        self.visited[url] = attempt + 1
+        self.seen.add(url)
+        return attempt
+
+    def putback(self, url, priority=0):
+        self._push(url, priority)
+
+    def domains(self):
+        """Returns the domains with URLs queued separately."""
+        return list(self.queues.keys())
+
+    def restart(self, urls):
+        """Replaces the URLs to be crawled with those in urls that were not
+        visited yet, and returns them.
+        """
+        if self.compact:
+            urls = [url for url in urls if url not in self.seen]
+            for url in urls:
+                self.seen.add(url)
+        else:
+            urls = [url for url in urls if url not in self.visited]
+            self.seen = set(urls)
+        self.targets = []
+        for url in urls:
+            self._push(url)
+        return urls
+
+    def add_outer(self, domain, url):
+        if domain not in self.outerdomaintargets:
+            self.outerdomaintargets[domain] = set()
+        self.outerdomaintargets[domain].add(url)
+
+    def outer_domains(self):
+        return len(self.outerdomaintargets)
+
+    def pop_outer(self):
+        domain = list(self.outerdomaintargets.keys())[0]
+        urls = self.outerdomaintargets[domain]
+        del self.outerdomaintargets[domain]
+        return urls
+
+    def counts(self):
+        """Returns the number of URLs seen and the number of URLs visited."""
+        if self.compact:
+            return len(self.seen), len(self.seen) - len(self)
+        return len(self.seen), len(self.visited)
+
+    def checkpoint(self):
+        pass
+
+    def close(self):
+        pass
+
+    def get_status(self):
+        status = { 'visited':self.visited , 'targets':self.targets , 'seen':self.seen }
+        if self.queues:
+            status['queues'] = self.queues
+        if self.prioritised:
+            status['prioritised'] = True
+        return status
+
+    def set_status(self, statusobj):
+        self.visited=statusobj['visited']
+        self.targets=statusobj['targets']
+        self.seen=statusobj['seen']
+        self.queues=statusobj.get('queues', {})
+        self.queued=sum(len(queue) for queue in self.queues.values())
+        if statusobj.get('prioritised', False) != self.prioritised:
+            # The crawling is continued with a different queue order
+            urls = [entry[2] if isinstance(entry, tuple) else entry for entry in self.targets]
+            queues = self.queues
+            self.targets = []
+            self.queues = {}
+            self.queued = 0
+            for url in urls:
+                self._push(url)
+            for queue in queues.values():
+                for entry in queue:
+                    self._push(entry[2] if isinstance(entry, tuple) else entry)
+
+class SqliteFrontier(MemoryFrontier):
+    """Crawl frontier stored in an SQLite database, so the memory used does not
+    grow with the number of URLs. Changes are committed every
+    checkpoint_interval seconds, so an interrupted crawling can be continued
+    from the database even if the crawler did not stop cleanly.
+    """
+    def __init__(self, path, resume=False, checkpoint_interval=60):
+        self.path = path
+        self.checkpoint_interval = checkpoint_interval
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        if not resume:
+            self.db.executescript('DROP TABLE IF EXISTS urls; DROP TABLE IF EXISTS targets; DROP TABLE IF EXISTS outer_targets;')
+        # urls contains every URL seen; attempts is 0 for those not visited yet
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, attempts INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS targets (id INTEGER PRIMARY KEY, url TEXT NOT NULL, domain TEXT, priority REAL NOT NULL DEFAULT 0);
+            CREATE TABLE IF NOT EXISTS outer_targets (domain TEXT NOT NULL, url TEXT NOT NULL, PRIMARY KEY (domain, url)) WITHOUT ROWID;
+        """)
+        if 'priority' not in [row[1] for row in self.db.execute('PRAGMA table_info(targets)')]:
+            self.db.execute('ALTER TABLE targets ADD COLUMN priority REAL NOT NULL DEFAULT 0')
+        # URLs are popped by priority and, within the same priority, in LIFO order
+        self.db.executescript("""
+            DROP INDEX IF EXISTS targets_domain;
+            CREATE INDEX IF NOT EXISTS targets_order ON targets (domain, priority, id);
+        """)
+        self.db.commit()
+        self.pending = self.db.execute('SELECT COUNT(*) FROM targets').fetchone()[0]
+        # The numbers of URLs seen and visited are counted once and then kept up to date
+        self.nseen, self.nvisited = self.db.execute('SELECT COUNT(*), SUM(attempts > 0) FROM urls').fetchone()
+        self.nvisited = self.nvisited or 0
+        self.lastcheckpoint = time.time()
+        self.key = None
+
+    @staticmethod
+    def is_database(path):
+        with open(path, 'rb') as f:
+            return f.read(16) == b'SQLite format 3\x00'
+
+    def __len__(self):
+        return self.pending
+
+    def _tick(self):
+        if time.time() - self.lastcheckpoint > self.checkpoint_interval:
+            self.checkpoint()
+
+    def _push(self, url, priority=0):
+        domain = self.key(url) if self.key is not None else None
+        self.db.execute('INSERT INTO targets (url, domain, priority) VALUES (?, ?, ?)', (url, domain, priority))
+        self.pending += 1
+
+    def add(self, url, priority=0):
+        if self.db.execute('INSERT OR IGNORE INTO urls (url) VALUES (?)', (url,)).rowcount == 0:
+            return False
+        self.nseen += 1
+        self._push(url, priority)
+        self._tick()
+        return True
+
+    def pop(self, domain=None):
+        row = self.db.execute('SELECT id, url FROM targets WHERE domain IS ? ORDER BY priority DESC, id DESC LIMIT 1', (domain,)).fetchone()
+        if row is None:
+            return None
+        self.db.execute('DELETE FROM targets WHERE id = ?', (row[0],))
+        self.nseen += self.db.execute('INSERT OR IGNORE INTO urls (url) VALUES (?)', (row[1],)).rowcount
+        self.nvisited += self.db.execute('UPDATE urls SET attempts = 1 WHERE url = ? AND attempts = 0', (row[1],)).rowcount
+        self.pending -= 1
+        self._tick()
+        return row[1]
+
+    def retry(self, url, max_attempts=5, priority=0):
+        attempt = self.db.execute('SELECT attempts FROM urls WHERE url = ?', (url,)).fetchone()[0]
+        if attempt > max_attempts:
+            return None
+        self._push(url, priority)
+        self.db.execute('UPDATE urls SET attempts = ? WHERE url = ?', (attempt + 1, url))
+        if attempt == 0:
+            self.nvisited += 1
+        self._tick()
+        return attempt
+
+    def putback(self, url, priority=0):
+        self._push(url, priority)
+
+    def domains(self):
+        return [row[0] for row in self.db.execute('SELECT DISTINCT domain FROM targets WHERE domain IS NOT NULL')]
+
+    def restart(self, urls):
+        self.db.execute('DELETE FROM targets')
+        targets = []
+        for url in urls:
+            row = self.db.execute('SELECT attempts FROM urls WHERE url = ?', (url,)).fetchone()
+            if row is None or row[0] == 0:
+                self.nseen += self.db.execute('INSERT OR IGNORE INTO urls (url) VALUES (?)', (url,)).rowcount
+                self.db.execute('INSERT INTO targets (url) VALUES (?)', (url,))
+                targets.append(url)
+        self.pending = len(targets)
+        self.checkpoint()
+        return targets
+
+    def add_outer(self, domain, url):
+        self.db.execute('INSERT OR IGNORE INTO outer_targets (domain, url) VALUES (?, ?)', (domain, url))
+        self._tick()
+
+    def outer_domains(self):
+        return self.db.execute('SELECT COUNT(DISTINCT domain) FROM outer_targets').fetchone()[0]
+
+    def pop_outer(self):
+        domain = self.db.execute('SELECT domain FROM outer_targets LIMIT 1').fetchone()[0]
+        urls = [row[0] for row in self.db.execute('SELECT url FROM outer_targets WHERE domain = ?', (domain,))]
+        self.db.execute('DELETE FROM outer_targets WHERE domain = ?', (domain,))
+        return urls
+
+    def counts(self):
+        return self.nseen, self.nvisited
+
+    def checkpoint(self):
+        self.db.commit()
+        self.lastcheckpoint = time.time()
+
+    def close(self):
+        self.checkpoint()
+        self.db.close()
+
+    def get_status(self):
+        raise RuntimeError('the crawling status is kept in the database '+self.path)
+
+class DNSCache(object):
+    """Cache of the addresses of hostnames. Lookups run in a pool of threads,
+    so the hosts of the links can be resolved in the background as soon as
+    their URLs are queued. The system resolver does not give the TTL of the
+    records, so addresses are kept for ttl seconds and failed lookups for
+    negative_ttl seconds.
+    """
+    def __init__(self, ttl=300, negative_ttl=60, maxsize=100000, workers=8):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self.workers = workers
+        self.entries = OrderedDict()
+        self.pending = {}
+        self.lock = Lock()
+        # Started on the first lookup, so a crawling process can be forked before
+        self.executor = None
+
+    def _lookup(self, hostname):
+        result = None
+        try:
+            try:
+                infos = socket.getaddrinfo(hostname, None, 0, socket.SOCK_STREAM)
+                result = list(OrderedDict.fromkeys((info[0], info[4][0]) for info in infos))
+                ttl = self.ttl
+            except (socket.gaierror, UnicodeError) as e:
+                # Hostnames that are not valid IDNA, such as a..b, fail like unknown ones
+                result = e if isinstance(e, socket.gaierror) else socket.gaierror(socket.EAI_NONAME, 'invalid hostname %s: %s' % (hostname, e))
+                ttl = self.negative_ttl
+            with self.lock:
+                self.entries[hostname] = (time.time() + ttl, result)
+                self.entries.move_to_end(hostname)
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+            return result
+        finally:
+            with self.lock:
+                self.pending.pop(hostname, None)
+
+    def _cached(self, hostname):
+        # Must be called with self.lock held
+        entry = self.entries.get(hostname)
+        if entry is not None and entry[0] > time.time():
+            return entry[1]
+        return None
+
+    def _submit(self, hostname):
+        # Must be called with self.lock held
+        future = self.pending.get(hostname)
+        if future is None:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(self.workers)
+            future = self.executor.submit(self._lookup, hostname)
+            self.pending[hostname] = future
+        return future
+
+    @staticmethod
+    def _addresses(result):
+        if isinstance(result, socket.gaierror):
+            raise socket.gaierror(*result.args)
+        return result
+
+    def prefetch(self, hostname):
+        with self.lock:
+            if self._cached(hostname) is None:
+                self._submit(hostname)
+
+    def resolve(self, hostname):
+        """Returns the addresses of hostname, waiting for its lookup if it is
+        not cached; raises socket.gaierror if the lookup failed.
+        """
+        with self.lock:
+            result = self._cached(hostname)
+            if result is None:
+                future = self._submit(hostname)
+        if result is None:
+            result = future.result()
+        return self._addresses(result)
+
+    async def async_resolve(self, hostname):
+        with self.lock:
+            result = self._cached(hostname)
+            if result is None:
+                future = self._submit(hostname)
+        if result is None:
+            result = await asyncio.wrap_future(future)
+        return self._addresses(result)
+
+    def create_connection(self, address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+        """Replacement of socket.create_connection for http.client that
+        connects to the cached addresses of the host, trying them in turn.
+        """
+        error = None
+        for family, ip in self.resolve(address[0]):
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            try:
+                if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                    sock.settimeout(timeout)
+                if source_address:
+                    sock.bind(source_address)
+                sock.connect((ip, address[1]))
+                return sock
+            except OSError as e:
+                sock.close()
+                error = e
+        raise error
+
+    def opener(self):
+        """Returns a urllib opener whose connections use the cache."""
+        dns = self
+        def connection(cls):
+            def create(*args, **kwargs):
+                conn = cls(*args, **kwargs)
+                conn._create_connection = dns.create_connection
+                return conn
+            return create
+        class HTTPHandler(urllib.request.HTTPHandler):
+            def http_open(self, req):
+                return self.do_open(connection(http.client.HTTPConnection), req)
+        class HTTPSHandler(urllib.request.HTTPSHandler):
+            def https_open(self, req):
+                return self.do_open(connection(http.client.HTTPSConnection), req, context=self._context)
+        return urllib.request.build_opener(HTTPHandler, HTTPSHandler)
+
+class ConnectionPool(object):
+    """Bounded pool of persistent HTTP connections keyed by (scheme, host,
+    port). Connections whose response has been fully read are kept alive and
+    reused for the next request to the same server, which saves the TCP and
+    TLS handshakes; connections idle for longer than idle_timeout are closed.
+    """
+    # Errors raised when the server closed a kept-alive connection on its side
+    STALE_ERRORS = (http.client.RemoteDisconnected, http.client.CannotSendRequest,
+                    BrokenPipeError, ConnectionResetError)
+
+    def __init__(self, timeout=10, maxsize=64, idle_timeout=15, drain_limit=65536, dns=None):
+        self.timeout = timeout
+        self.dns = dns
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.drain_limit = drain_limit
+        self.idle = {}
+        self.size = 0
+        self.lock = Lock()
+
+    def _key(self, protocol, host):
+        rx = re.match('(.*?)(?::([0-9]+))?$', host)
+        if rx.group(2):
+            port = int(rx.group(2))
+        else:
+            port = 80 if protocol == 'http' else 443
+        return (protocol, rx.group(1), port)
+
+    def _connect(self, key):
+        protocol, hostname, port = key
+        if protocol == 'http':
+            conn = http.client.HTTPConnection(hostname, port, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPSConnection(hostname, port, timeout=self.timeout)
+        if self.dns is not None:
+            conn._create_connection = self.dns.create_connection
+        conn.pool_key = key
+        return conn
+
+    def _evict(self, now):
+        # Must be called with self.lock held
+        for key in list(self.idle.keys()):
+            conns = self.idle[key]
+            while conns and now - conns[0][0] > self.idle_timeout:
+                conns.pop(0)[1].close()
+                self.size -= 1
+            if not conns:
+                del self.idle[key]
+
+    def acquire(self, protocol, host):
+        """Returns a tuple (connection, reused) for the server of the URL."""
+        key = self._key(protocol, host)
+        with self.lock:
+            self._evict(time.time())
+            conns = self.idle.get(key)
+            if conns:
+                conn = conns.pop()[1]
+                self.size -= 1
+                if not conns:
+                    del self.idle[key]
+                return conn, True
+        return self._connect(key), False
+
+    def request(self, protocol, host, path, headers={}):
+        """Sends a GET request on a pooled connection and returns a tuple
+        (connection, response); the connection has to be given back with
+        release() or discard() once the response is processed.
+        """
+        conn, reused = self.acquire(protocol, host)
+        try:
+            conn.request('GET', path, headers=headers)
+            return conn, conn.getresponse()
+        except self.STALE_ERRORS:
+            conn.close()
+            if not reused:
+                raise
+        except:
+            conn.close()
+            raise
+        # The server closed the persistent connection: open a new one
+        conn = self._connect(conn.pool_key)
+        try:
+            conn.request('GET', path, headers=headers)
+            return conn, conn.getresponse()
+        except:
+            conn.close()
+            raise
+
+    def release(self, conn, res):
+        """Gives back a connection once its response has been read."""
+        if res.will_close or not res.isclosed():
+            conn.close()
+            return
+        with self.lock:
+            now = time.time()
+            self._evict(now)
+            self.idle.setdefault(conn.pool_key, []).append((now, conn))
+            self.size += 1
+            while self.size > self.maxsize:
+                oldest = min(self.idle.keys(), key=lambda k: self.idle[k][0][0])
+                self.idle[oldest].pop(0)[1].close()
+                self.size -= 1
+                if not self.idle[oldest]:
+                    del self.idle[oldest]
+
+    def discard(self, conn, res):
+        """Gives back a connection whose response body is not wanted: short
+        bodies (such as those of redirects) are consumed so the connection can
+        be reused, while long ones are not downloaded and the connection is
+        closed. Returns the number of bytes of the body that were read.
+        """
+        drained = 0
+        try:
+            if not res.will_close and (res.length is None or res.length <= self.drain_limit):
+                while not res.isclosed() and drained <= self.drain_limit:
+                    chunk = res.read(8192)
+                    if not chunk:
+                        break
+                    drained += len(chunk)
+        except (http.client.HTTPException, EnvironmentError):
+            conn.close()
+            return drained
+        self.release(conn, res)
+        return drained
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for _, conn in conns:
+                    conn.close()
+            self.idle = {}
+            self.size = 0
+
+class AsyncResponse(object):
+    """Response of the asyncio engine. It mimics the part of the interface of
+    http.client.HTTPResponse used by the crawler, so Document can be built
+    from it in the same way. Only the status line and the headers are read
+    at first: the body is read with load(), and the connection has to be
+    closed with close().
+    """
+    def __init__(self, status, reason, msg, reader, writer):
+        self.status = status
+        self.reason = reason
+        self.msg = msg
+        self.reader = reader
+        self.writer = writer
+        self.body = b''
+        self.length = 0
+
+    async def _chunks(self):
+        if self.status in (204, 304) or 100 <= self.status < 200:
+            return
+        if (self.msg.get('Transfer-Encoding') or '').lower() == 'chunked':
+            while True:
+                size = int((await self.reader.readline()).split(b';', 1)[0].strip(), 16)
+                if size == 0:
+                    while (await self.reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    return
+                while size > 0:
+                    chunk = await self.reader.readexactly(min(size, 65536))
+                    size -= len(chunk)
+                    yield chunk
+                await self.reader.readexactly(2)
+        elif self.msg.get('Content-Length') is not None:
+            remaining = int(self.msg.get('Content-Length'))
+            while remaining > 0:
+                chunk = await self.reader.readexactly(min(remaining, 65536))
+                remaining -= len(chunk)
+                yield chunk
+        else:
+            while True:
+                chunk = await self.reader.read(65536)
+                if not chunk:
+                    return
+                yield chunk
+
+    async def load(self, limit=None):
+        """Reads the body in chunks and decompresses it; DocumentTooLarge is
+        raised as soon as more than limit bytes are read or decompressed.
+        length is the number of bytes received.
+        """
+        decoder = BodyDecoder(self.msg.get('Content-Encoding'), limit)
+        chunks = []
+        async for chunk in self._chunks():
+            self.length += len(chunk)
+            chunks.append(decoder.decompress(chunk))
+            if limit is not None and max(self.length, decoder.size) > limit:
+                raise DocumentTooLarge(self.length)
+        chunks.append(decoder.flush())
+        self.body = b''.join(chunks)
+
+    def close(self):
+        self.writer.close()
+
+    def read(self):
+        body = self.body
+        self.body = b''
+        return body
+
+    def getheader(self, name, default=None):
+        return self.msg.get(name, default)
+
+    def getheaders(self):
+        return list(self.msg.items())
+
+class RobotsCache(object):
+    """robots.txt rules of every host (scheme, host and port), downloaded the
+    first time a URL of the host is checked and kept for ttl seconds. If the
+    robots.txt of a host cannot be downloaded (network errors, 5xx
+    responses), crawling the host is allowed and the failure is remembered
+    for negative_ttl seconds, so the file is not requested again for every
+    URL. Only the first max_size bytes of robots.txt are read. The
+    Crawl-delay and Request-rate of the rules are kept by host, so
+    the scheduler can apply them. At most maxsize hosts are kept; the least
+    recently used are dropped first. The files are downloaded with opener,
+    a urllib opener, if it is set.
+    """
+    def __init__(self, ttl=86400, negative_ttl=600, timeout=10, maxsize=10000, max_size=512000):
+        self.opener = None
+        self.ttl = ttl
+        self.max_size = max_size
+        self.negative_ttl = negative_ttl
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.delays = {}
+        self.locks = {}
+        self.lock = Lock()
+
+    @staticmethod
+    def origin(url):
+        rx = re.match('(https?)://([^/?#]+)', url)
+        return (rx.group(1) + "://" + rx.group(2)).lower()
+
+    def get(self, url):
+        """Returns the rules for the host of url, or None if they have to be
+        downloaded.
+        """
+        origin = self.origin(url)
+        with self.lock:
+            entry = self.entries.get(origin)
+            if entry is None or entry[1] < time.time():
+                return None
+            self.entries.move_to_end(origin)
+            return entry[0]
+
+    def store(self, origin, status, lines):
+        """Keeps the rules of origin given the status of the request for its
+        robots.txt (None if it failed) and the lines of the file.
+        """
+        parser = urllib.robotparser.RobotFileParser(origin + "/robots.txt")
+        ttl = self.ttl
+        if status is None or status >= 500:
+            sys.stderr.write("It was not possible to retrieve the robots.txt file for "+origin+"\n")
+            ttl = self.negative_ttl
+        elif status in (401, 403):
+            parser.disallow_all = True
+        elif status >= 400:
+            parser.allow_all = True
+        else:
+            parser.parse(lines)
+        parser.modified()
+
+        delay = parser.crawl_delay("*")
+        rate = parser.request_rate("*")
+        if rate is not None and rate.requests > 0:
+            delay = max(delay or 0, rate.seconds / rate.requests)
+        with self.lock:
+            self.entries[origin] = (parser, time.time() + ttl)
+            self.entries.move_to_end(origin)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+            host = origin.split("://", 1)[1]
+            if delay:
+                self.delays[host] = float(delay)
+            else:
+                self.delays.pop(host, None)
+        return parser
+
+    def fetch(self, url):
+        """Downloads the robots.txt for the host of url, unless another thread
+        is already doing it, and returns its rules.
+        """
+        origin = self.origin(url)
+        with self.lock:
+            lock = self.locks.setdefault(origin, Lock())
+        with lock:
+            parser = self.get(url)
+            if parser is not None:
+                return parser
+            try:
+                urlopen = self.opener.open if self.opener is not None else urllib.request.urlopen
+                with urlopen(origin + "/robots.txt", timeout=self.timeout) as f:
+                    parser = self.store(origin, f.status, f.read(self.max_size).decode("utf-8", "replace").splitlines())
+            except urllib.error.HTTPError as err:
+                parser = self.store(origin, err.code, [])
+            except (IOError, CertificateError, http.client.HTTPException, ValueError):
+                parser = self.store(origin, None, [])
+        with self.lock:
+            self.locks.pop(origin, None)
+        return parser
+
+    def can_fetch(self, url):
+        parser = self.get(url)
+        if parser is None:
+            parser = self.fetch(url)
+        return parser.can_fetch("*", url)
+
+    def crawl_delay(self, host):
+        """Returns the delay between requests asked by the robots.txt of
+        host, or 0.
+        """
+        return self.delays.get(host.lower(), 0)
+
+class SitemapReader(object):
+    """Reads the sitemaps of a website (sitemaps.org protocol) and their
+    indexes, plain or gzipped. Files are parsed while they are downloaded
+    and every URL is returned as soon as it is read, so big sitemaps are
+    not kept in memory. At most max_sitemaps files and max_urls URLs are
+    read.
+    """
+    def __init__(self, timeout=10, max_sitemaps=1000, max_urls=1000000):
+        self.timeout = timeout
+        self.max_sitemaps = max_sitemaps
+        self.max_urls = max_urls
+
+    @staticmethod
+    def _tag(elem):
+        # Tag name without namespace
+        return elem.tag.rsplit('}', 1)[-1]
+
+    def _parse(self, f):
+        """Yields ('sitemap', loc, None, None) for the entries of a sitemap
+        index and ('url', loc, lastmod, alternates) for the URLs of a sitemap,
+        where alternates is a list of (hreflang, URL) tuples.
+        """
+        root = None
+        for event, elem in ElementTree.iterparse(f, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = elem
+                continue
+            tag = self._tag(elem)
+            if tag not in ('url', 'sitemap'):
+                continue
+            loc = None
+            lastmod = None
+            alternates = []
+            for child in elem:
+                name = self._tag(child)
+                if name == 'loc' and child.text:
+                    loc = child.text.strip()
+                elif name == 'lastmod' and child.text:
+                    lastmod = child.text.strip()
+                elif name == 'link' and child.get('rel') == 'alternate' and child.get('href') and child.get('hreflang'):
+                    alternates.append((child.get('hreflang'), child.get('href').strip()))
+            if loc:
+                yield tag, loc, lastmod, alternates
+            # Entries already read are dropped
+            root.clear()
+
+    def urls(self, sitemaps):
+        """Yields a tuple (URL, lastmod, alternates) for every URL in the
+        sitemaps, following sitemap indexes.
+        """
+        pending = list(sitemaps)
+        done = set()
+        count = 0
+        while pending and len(done) < self.max_sitemaps:
+            sitemap = pending.pop(0)
+            if sitemap in done:
+                continue
+            done.add(sitemap)
+            try:
+                with urllib.request.urlopen(sitemap, timeout=self.timeout) as res:
+                    f = io.BufferedReader(res)
+                    if f.peek(2)[:2] == b'\x1f\x8b':
+                        f = gzip.GzipFile(fileobj=f)
+                    for tag, loc, lastmod, alternates in self._parse(f):
+                        if tag == 'sitemap':
+                            pending.append(loc)
+                            continue
+                        yield loc, lastmod, alternates
+                        count += 1
+                        if count >= self.max_urls:
+                            return
+            except urllib.error.HTTPError as err:
+                if err.code != 404:
+                    sys.stderr.write("It was not possible to retrieve the sitemap "+sitemap+": "+str(err)+"\n")
+            except (IOError, CertificateError, http.client.HTTPException, ElementTree.ParseError, EOFError, ValueError) as err:
+                sys.stderr.write("It was not possible to read the sitemap "+sitemap+": "+str(err)+"\n")
+
+class HostScheduler(object):
+    """Politeness policy applied per host: it keeps, for every host, the
+    earliest time at which the next request to it can be sent.
+    """
+    def __init__(self, delay=0, robots=None):
+        self.delay = delay
+        self.robots = robots
+        self.next_fetch = {}
+        self.lock = Lock()
+
+    def _delay(self, host, delay):
+        # The Crawl-delay set in robots.txt is honoured
+        if self.robots is None:
+            return delay
+        return max(delay, self.robots.crawl_delay(host))
+
+    def available(self, host):
+        """Returns whether a slot can be booked for host now."""
+        return True
+
+    def reserve(self, host):
+        """Books the next free slot for host and returns the number of
+        seconds the caller has to wait before sending its request.
+        """
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_fetch.get(host, 0.0))
+            self.next_fetch[host] = slot + self._delay(host, self.delay)
+            return slot - now
+
+    def done(self, host, latency=None, status=None, retry_after=None):
+        """Notifies that a request to host finished, with its latency in
+        seconds, its HTTP status (None if it failed) and the value of its
+        Retry-After header, if any.
+        """
+        pass
+
+class AdaptiveHostScheduler(HostScheduler):
+    """Politeness policy that adapts the delay and the number of requests in
+    progress for every host to the way it responds, in the spirit of Scrapy's
+    AutoThrottle. It keeps, for every host, an exponentially weighted moving
+    average (EWMA) of the response latency and of the error rate (failed
+    requests, 429 and 5xx responses). The delay tends to latency/concurrency,
+    so fast servers are crawled close to their capacity, and it is doubled
+    after every error; the concurrency grows by one request every time that a
+    whole window of requests succeeds and it is halved after an error. Both
+    are kept within the bounds given, and Retry-After headers are honoured.
+    """
+    def __init__(self, delay=5, min_delay=0, max_delay=60, min_concurrency=1, max_concurrency=4, alpha=0.3, robots=None):
+        HostScheduler.__init__(self, delay, robots)
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.alpha = alpha
+        self.hosts = {}
+
+    def _host(self, host):
+        # Must be called with self.lock held
+        if host not in self.hosts:
+            self.hosts[host] = {'delay': min(max(self.delay, self.min_delay), self.max_delay),
+                'concurrency': float(self.min_concurrency), 'inflight': 0,
+                'latency': None, 'errors': 0.0}
+        return self.hosts[host]
+
+    def available(self, host):
+        with self.lock:
+            state = self._host(host)
+            return state['inflight'] < int(state['concurrency'])
+
+    def reserve(self, host):
+        """Books the next free slot for host and returns the number of seconds
+        the caller has to wait before sending its request, or None if host
+        already has as many requests in progress as allowed; in that case the
+        caller has to try again later. Every booked slot has to be released
+        with done().
+        """
+        with self.lock:
+            state = self._host(host)
+            if state['inflight'] >= int(state['concurrency']):
+                return None
+            state['inflight'] += 1
+            now = time.time()
+            slot = max(now, self.next_fetch.get(host, 0.0))
+            self.next_fetch[host] = slot + self._delay(host, state['delay'])
+            return slot - now
+
+    def done(self, host, latency=None, status=None, retry_after=None):
+        with self.lock:
+            state = self._host(host)
+            state['inflight'] = max(0, state['inflight'] - 1)
+            error = status is None or status == 429 or status >= 500
+            state['errors'] = self.alpha * error + (1 - self.alpha) * state['errors']
+            if latency is not None and status is not None:
+                if state['latency'] is None:
+                    state['latency'] = latency
+                else:
+                    state['latency'] = self.alpha * latency + (1 - self.alpha) * state['latency']
+
+            if error:
+                state['delay'] = min(self.max_delay, max(state['delay'] * 2, self.min_delay, 0.1))
+                state['concurrency'] = max(float(self.min_concurrency), state['concurrency'] / 2)
+            elif state['latency'] is not None:
+                target = state['latency'] / int(state['concurrency'])
+                delay = (state['delay'] + target) / 2
+                # The delay is not reduced while the host keeps failing
+                if delay > state['delay'] or state['errors'] < 0.1:
+                    state['delay'] = min(self.max_delay, max(self.min_delay, delay))
+                if state['errors'] < 0.1:
+                    state['concurrency'] = min(float(self.max_concurrency), state['concurrency'] + 1 / int(state['concurrency']))
+
+            wait = self.parse_retry_after(retry_after)
+            if wait is not None:
+                self.next_fetch[host] = max(self.next_fetch.get(host, 0.0), time.time() + wait)
+
+    @staticmethod
+    def parse_retry_after(value):
+        """Returns the seconds to wait according to a Retry-After header, that
+        can be either a number of seconds or an HTTP date, or None.
+        """
+        if not value:
+            return None
+        value = value.strip()
+        if value.isdigit():
+            return float(value)
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError, IndexError):
+            return None
+
+class DomainScheduler(object):
+    """Scheduler used to crawl several domains of a TLD at the same time.
+    Every domain has its own queue in the frontier; up to maxdomains domains
+    are active at once and they take turns (round robin) to provide the next
+    URL, with at most per_domain downloads in progress for each of them.
+    When an active domain runs out of URLs, the next domain waiting in the
+    frontier takes its place.
+    """
+    def __init__(self, frontier, maxdomains, per_domain=1):
+        self.frontier = frontier
+        self.maxdomains = maxdomains
+        self.per_domain = per_domain
+        # Active domains and the number of downloads in progress for each of them
+        self.active = OrderedDict()
+        self.lastrefill = 0.0
+
+    def _refill(self):
+        now = time.time()
+        if len(self.active) >= self.maxdomains or (self.active and now - self.lastrefill < 1):
+            return
+        self.lastrefill = now
+        for domain in self.frontier.domains():
+            if len(self.active) >= self.maxdomains:
+                break
+            if domain not in self.active:
+                self.active[domain] = 0
+
+    def next(self):
+        """Returns the next URL to be downloaded, or None if every active
+        domain is busy or has no URLs left. The frontier must be locked.
+        """
+        url = self.frontier.pop()
+        if url is not None:
+            return url
+        self._refill()
+        for _ in range(len(self.active)):
+            domain, inflight = self.active.popitem(last=False)
+            self.active[domain] = inflight
+            if inflight >= self.per_domain:
+                continue
+            url = self.frontier.pop(domain)
+            if url is not None:
+                self.active[domain] = inflight + 1
+                return url
+            if inflight == 0:
+                # Nothing left to be crawled in this domain
+                del self.active[domain]
+        return None
+
+    def done(self, url):
+        """Notifies that the download of a URL returned by next() finished.
+        The frontier must be locked.
+        """
+        domain = self.frontier.key(url)
+        if self.active.get(domain, 0) > 0:
+            self.active[domain] -= 1
+
+class TrapDetector(object):
+    """Detects near-duplicate documents and crawler traps (calendars, session
+    ids in URLs, faceted navigation...) while crawling. Every document is
+    fingerprinted with SimHash (Charikar, 2002) over the 3-word shingles of
+    its text, and two documents are near-duplicates if their fingerprints
+    differ in at most max_distance bits; they are found by indexing the four
+    16-bit blocks of the fingerprints, as at least one of them has to be
+    identical. URLs are generalised into patterns (numbers and long tokens
+    replaced, values of the query dropped) and the ratio of near-duplicates
+    is kept for every pattern: once a pattern has min_samples documents,
+    its URLs are demoted if the ratio reaches demote_ratio and pruned if it
+    reaches prune_ratio. At most max_fingerprints documents are indexed.
+    """
+    SCRIPT_RX = re.compile(r'<(script|style)\b.*?</\1\s*>', re.S | re.I)
+    TAG_RX = re.compile(r'<[^>]*>')
+    WORD_RX = re.compile(r'\w+')
+    TOKEN_RX = re.compile(r'[0-9a-fA-F]{16,}|[0-9a-zA-Z_-]{32,}')
+    NUMBER_RX = re.compile(r'[0-9]+')
+
+    def __init__(self, max_distance=3, min_samples=10, demote_ratio=0.5, prune_ratio=0.9, max_fingerprints=1000000):
+        self.max_distance = max_distance
+        self.min_samples = min_samples
+        self.demote_ratio = demote_ratio
+        self.prune_ratio = prune_ratio
+        self.max_fingerprints = max_fingerprints
+        self.blocks = [{} for _ in range(4)]
+        self.fingerprints = 0
+        # Number of documents and of near-duplicates of every pattern
+        self.patterns = {}
+        self.lock = Lock()
+
+    def fingerprint(self, text):
+        """Returns the 64-bit SimHash of an HTML document, or None if it has
+        too little text.
+        """
+        text = self.TAG_RX.sub(' ', self.SCRIPT_RX.sub(' ', text.decode('utf8', 'replace')))
+        words = self.WORD_RX.findall(text.lower())
+        shingles = set(' '.join(words[i:i+3]) for i in range(len(words) - 2))
+        if not shingles:
+            return None
+        bits = [format(int.from_bytes(hashlib.blake2b(shingle.encode('utf8', 'surrogatepass'), digest_size=8).digest(), 'big'), '064b') for shingle in shingles]
+        # Every bit is set if it is set in more than half of the shingles
+        fingerprint = 0
+        for column in zip(*bits):
+            fingerprint = (fingerprint << 1) | (column.count('1') * 2 > len(bits))
+        return fingerprint
+
+    def pattern(self, url):
+        rx = URL_RX.match(url)
+        if rx is None:
+            return url
+        pattern = rx.group(2) + self.NUMBER_RX.sub('N', self.TOKEN_RX.sub('T', rx.group(4)))
+        if rx.group(5):
+            pattern += '?' + '&'.join(sorted(set(param.split('=', 1)[0] for param in rx.group(5)[1:].split('&'))))
+        return pattern
+
+    def _ratio(self, pattern):
+        # Must be called with self.lock held
+        stats = self.patterns.get(pattern)
+        if stats is None or stats[0] < self.min_samples:
+            return 0.0
+        return stats[1] / stats[0]
+
+    def add(self, url, text):
+        """Indexes a document and returns True if it is a near-duplicate of
+        one indexed before.
+        """
+        fingerprint = self.fingerprint(text)
+        if fingerprint is None:
+            return False
+        keys = [(fingerprint >> (16 * i)) & 0xffff for i in range(4)]
+        pattern = self.pattern(url)
+        with self.lock:
+            duplicate = False
+            for block, key in zip(self.blocks, keys):
+                for other in block.get(key, ()):
+                    if bin(fingerprint ^ other).count('1') <= self.max_distance:
+                        duplicate = True
+                        break
+                if duplicate:
+                    break
+            if not duplicate and self.fingerprints < self.max_fingerprints:
+                for block, key in zip(self.blocks, keys):
+                    block.setdefault(key, []).append(fingerprint)
+                self.fingerprints += 1
+            stats = self.patterns.setdefault(pattern, [0, 0])
+            stats[0] += 1
+            stats[1] += duplicate
+            return duplicate
+
+    def pruned(self, url):
+        with self.lock:
+            return self._ratio(self.pattern(url)) >= self.prune_ratio
+
+    def penalty(self, url):
+        """Returns the amount by which the priority of url is lowered, or None
+        if its pattern has to be pruned.
+        """
+        with self.lock:
+            ratio = self._ratio(self.pattern(url))
+        if ratio >= self.prune_ratio:
+            return None
+        if ratio >= self.demote_ratio:
+            return -5 * ratio
+        return 0
+
+class WARCWriter(object):
+    """Writes the WARC records of the crawled documents from a dedicated
+    thread, fed through a queue, so the crawling jobs do not wait for the
+    output. Records are written to standard output, uncompressed, unless a
+    prefix is given: then every record is gzipped separately and written to
+    the files PREFIX-00000.warc.gz, PREFIX-00001.warc.gz, ..., starting a new
+    file once the current one reaches maxsize bytes. When sink is given, the
+    uncompressed records are passed to it instead of writing them. If writing
+    fails, the records left are discarded and the error is raised again by
+    write and close.
+    """
+    def __init__(self, prefix=None, maxsize=None, queuesize=1000, sink=None):
+        self.prefix = prefix
+        self.sink = sink
+        self.maxsize = maxsize
+        self.number = 0
+        self.size = 0
+        self.f = None
+        self.queue = queue.Queue(queuesize)
+        self.error = None
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, record):
+        if self.error != None:
+            raise self.error
+        self.queue.put(record)
+
+    def _open(self):
+        if self.f != None:
+            self.f.close()
+        # Files left by a previous crawling are not overwritten
+        while os.path.exists("%s-%05d.warc.gz" % (self.prefix, self.number)):
+            self.number += 1
+        self.f = open("%s-%05d.warc.gz" % (self.prefix, self.number), 'wb')
+        self.size = 0
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            # The queue is still drained after an error, so the crawling jobs are not blocked
+            if self.error != None:
+                continue
+            try:
+                self._write(record)
+            except Exception as e:
+                self.error = e
+
+    def _write(self, record):
+        buf = io.BytesIO()
+        record.write_to(buf)
+        data = buf.getvalue()
+        if self.sink != None:
+            self.sink(data)
+            return
+        if self.prefix == None:
+            sys.stdout.buffer.write(data)
+            return
+        data = gzip.compress(data, compresslevel=6)
+        if self.f == None or (self.maxsize != None and self.size > 0 and self.size + len(data) > self.maxsize):
+            self._open()
+        self.f.write(data)
+        self.size += len(data)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.f != None:
+            self.f.close()
+            self.f = None
+        elif self.sink == None and self.error == None:
+            sys.stdout.flush()
+        if self.error != None:
+            raise self.error
+
+class Shard(object):
+    """Part of a crawling split among several processes: every host belongs to
+    one of them, chosen by a hash of its name, so the delay between requests
+    to a host is still kept. The URLs of the hosts of other processes, the
+    WARC records and the progress reports are sent to the coordinator through
+    results; the URLs of the hosts of this process arrive through inbox.
+    """
+    def __init__(self, index, count, inbox, results, stop):
+        self.index = index
+        self.count = count
+        self.inbox = inbox
+        self.results = results
+        self.stop = stop
+        self.received = 0
+        self.idle = False
+        self.routed = set()
+        self.wakeup = Event()
+
+    @staticmethod
+    def owner(url, count):
+        rx = re.match('https?://([^/:?#]+)', url)
+        host = rx.group(1).lower() if rx else ''
+        return int.from_bytes(hashlib.md5(host.encode('utf-8')).digest()[:8], 'big') % count
+
+    def owns(self, url):
+        return self.owner(url, self.count) == self.index
+
+    def route(self, url, priority=0):
+        # The owner discards the URLs it has already seen, so this only saves messages; it is a set of 64-bit
+        # fingerprints instead of a Bloom filter, whose false positives would never reach the owner
+        fingerprint = int.from_bytes(hashlib.md5(url.encode('utf-8')).digest()[:8], 'big')
+        if fingerprint not in self.routed:
+            self.routed.add(fingerprint)
+            self.results.put(('url', url, priority))
+
+    def report(self, received, crawlsize):
+        self.results.put(('status', self.index, self.idle, received, crawlsize))
+
+class CrawlMetrics(object):
+    """Counters kept while crawling: requests in progress, responses by HTTP
+    status, retries, documents processed and, for every host, a histogram of
+    the response times and the time of its last response.
+    """
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, max_hosts=100):
+        self.lock = Lock()
+        self.max_hosts = max_hosts
+        self.started = time.time()
+        self.inflight = 0
+        self.requests = 0
+        self.documents = 0
+        self.statuses = {}
+        self.retries = 0
+        self.given_up = 0
+        self.hosts = {}
+        self.sample = (self.started, 0, 0.0)
+
+    def fetch_started(self):
+        with self.lock:
+            self.inflight += 1
+
+    def fetch_done(self):
+        with self.lock:
+            self.inflight -= 1
+
+    def response(self, host, latency, status):
+        with self.lock:
+            self.requests += 1
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            if host not in self.hosts:
+                self.hosts[host] = {'requests': 0, 'latency': 0.0, 'last': 0.0, 'histogram': [0] * (len(self.BUCKETS) + 1)}
+            stats = self.hosts[host]
+            stats['requests'] += 1
+            stats['latency'] += latency
+            stats['last'] = time.time()
+            stats['histogram'][bisect.bisect_left(self.BUCKETS, latency)] += 1
+
+    def retry(self, given_up=False):
+        with self.lock:
+            if given_up:
+                self.given_up += 1
+            else:
+                self.retries += 1
+
+    def document(self):
+        with self.lock:
+            self.documents += 1
+
+    def snapshot(self, crawler, update=True):
+        """Returns the metrics of crawler as a dictionary. Rates are those
+        since the previous snapshot taken with update set.
+        """
+        now = time.time()
+        crawlsize = crawler.crawlsize * 1000000
+        crawler.targets_lock.acquire()
+        try:
+            frontier = len(crawler.frontier)
+            seen, visited = crawler.frontier.counts()
+        finally:
+            crawler.targets_lock.release()
+        with self.lock:
+            elapsed = max(now - self.sample[0], 1e-6)
+            metrics = OrderedDict([
+                ('time', time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(now))),
+                ('elapsed', round(now - self.started, 3)),
+                ('documents', self.documents),
+                ('documents_per_second', round((self.documents - self.sample[1]) / elapsed, 3)),
+                ('bytes', int(crawlsize)),
+                ('bytes_per_second', round((crawlsize - self.sample[2]) / elapsed, 1)),
+                ('frontier', frontier),
+                ('seen', seen),
+                ('visited', visited),
+                ('in_flight', self.inflight),
+                ('connections', self.inflight + crawler.connections.size),
+                ('requests', self.requests),
+                ('statuses', OrderedDict((str(status), count) for status, count in sorted(self.statuses.items()))),
+                ('retries', self.retries),
+                ('given_up', self.given_up),
+            ])
+            # The hosts with most requests; a host with a large idle time may be stalled
+            hosts = OrderedDict()
+            for host, stats in sorted(self.hosts.items(), key=lambda item: -item[1]['requests'])[:self.max_hosts]:
+                histogram = OrderedDict(zip([str(bound) for bound in self.BUCKETS] + ['+Inf'], stats['histogram']))
+                hosts[host] = OrderedDict([
+                    ('requests', stats['requests']),
+                    ('mean_latency', round(stats['latency'] / stats['requests'], 4)),
+                    ('idle', round(now - stats['last'], 1)),
+                    ('latency_histogram', histogram),
+                ])
+            metrics['hosts'] = hosts
+            if update:
+                self.sample = (now, self.documents, crawlsize)
+        return metrics
+
+class MetricsReporter(object):
+    """Reports the metrics of a crawler while it runs: every interval seconds
+    they are appended as a JSON line to the file path, and at any time they
+    can be requested as JSON from a local HTTP server listening on port.
+    """
+    def __init__(self, crawler, path=None, port=None, interval=10):
+        self.crawler = crawler
+        self.interval = interval
+        self.f = open(path, 'a') if path is not None else None
+        self.server = None
+        self.stopped = Event()
+        if port is not None:
+            reporter = self
+            class Handler(http.server.BaseHTTPRequestHandler):
+                def log_message(self, format, *args):
+                    pass
+                def do_GET(self):
+                    body = json.dumps(reporter.crawler.metrics.snapshot(reporter.crawler, update=False)).encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+            self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+            self.server.daemon_threads = True
+            t = Thread(target=self.server.serve_forever)
+            t.daemon = True
+            t.start()
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _write(self):
+        metrics = self.crawler.metrics.snapshot(self.crawler)
+        if self.f is not None:
+            self.f.write(json.dumps(metrics) + '\n')
+            self.f.flush()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self._write()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        # The last line has the totals of the crawling
+        self._write()
+        if self.f is not None:
+            self.f.close()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+def read_validators(paths):
+    """Reads the WARC files (plain or gzipped) of a previous crawling and
+    returns, for every URL, a tuple (ETag, date for If-Modified-Since, WARC
+    date). The Last-Modified header of the page is used as the date when it
+    was kept; otherwise, the date when the page was downloaded. If a URL
+    appears several times, the last record is the one kept.
+    """
+    validators = {}
+    for path in paths:
+        with open(path, 'rb') as f:
+            compressed = f.read(2) == b'\x1f\x8b'
+        for record in warc.WARCFile(path, compress=compressed):
+            url = record.url
+            if url is None or record.type not in ('response', 'revisit'):
+                continue
+            modified = record.header.get('Last-Modified')
+            if modified is None:
+                try:
+                    date = datetime.datetime.strptime(record.date, '%Y-%m-%dT%H:%M:%SZ')
+                    modified = email.utils.format_datetime(date.replace(tzinfo=datetime.timezone.utc), usegmt=True)
+                except (TypeError, ValueError):
+                    pass
+            validators[url] = (record.header.get('ETag'), modified, record.date)
+    return validators
+
 class Crawler(object):
     F_ANY, F_SAME_DOMAIN, F_SAME_HOST, F_SAME_PATH, F_TLD = list(range(5))
+    # URLs of busy hosts skipped at most to find one that can be downloaded
+    MAX_SKIPPED = 100
     def __init__(self, debug=False):
         self.currdomain = ""
-        self.visited = {}
-        self.outerdomaintargets = {}
-        self.targets = []
-        self.seen = set()
-        self.threads = []
-        self.concurrency = 0
+        self.frontier = MemoryFrontier()
+        self.fetching = 0
         self.max_outstanding = 16
         self.max_depth = 50
         self.root_url = None
@@ -68,21 +1636,38 @@ class Crawler(object):
         self.crawlsize = 0.0
         self.sizelimit = None
         self.timelimit = None
-        self.robotsparser = urllib.robotparser.RobotFileParser()
+        self.robots = RobotsCache()
         self.interrupt = False
         self.timeout = 10
         self.TLdomain = ""
         self.verbose=False
         self.delay=0
+        self.use_asyncio=False
+        self.scheduler=None
+        self.maxdomains=1
+        self.domains=None
+        self.ssl_context=None
+        self.languages=None
+        self.lang_rx=None
+        self.validators=None
+        self.use_sitemaps=False
+        self.max_document_size=None
+        self.traps=None
+        self.shard=None
+        self.metrics=CrawlMetrics()
 
         self.follow_mode = self.F_SAME_HOST
         self.content_type_filter = '(text/html)'
         self.url_filters = []
         self.prefix_filter = '^(#|javascript:|mailto:)'
+        self.link_filter = None
 
-        self.targets_lock = Lock()
+        self.targets_lock = RLock()
         self.concurrency_lock = Lock()
-        self.delay_lock = Lock()
+        self.work = Condition(self.targets_lock)
+        self.dns = DNSCache()
+        self.robots.opener = self.dns.opener()
+        self.connections = ConnectionPool(self.timeout, dns=self.dns)
 
         logging.basicConfig(level=logging.DEBUG if debug else logging.ERROR)
 
@@ -93,9 +1678,12 @@ class Crawler(object):
 
     def set_timeout(self, time):
         self.timeout=time
+        self.connections.timeout=time
+        self.robots.timeout=time
 
     def add_url_filter(self, uf):
         self.url_filters.append(uf)
+        self.link_filter = None
 
     def set_follow_mode(self, mode):
         if mode > 6:
@@ -108,103 +1696,316 @@ class Crawler(object):
     def set_max_depth(self, max_depth):
         self.max_depth = max_depth
 
+    def set_languages(self, languages):
+        """Prioritises the URLs most likely to lead to documents in these
+        languages (ISO 639-1 codes) with a translation in the other one, so
+        they are downloaded first if the crawling is cut short by -s or -t.
+        """
+        self.languages = [lang.lower() for lang in languages]
+        self.lang_rx = re.compile(r'[/_.=&?-](?:%s)(?:[-_][a-z]{2})?(?=$|[/_.=&?#-])' %
+            '|'.join(re.escape(lang) for lang in self.languages), re.I)
+        self.frontier.prioritised = True
+
     def process_document(self, doc):
         print('GET', doc.status, doc.url, doc.links)
         #to do stuff with url depth use self._calc_depth(doc.url)
 
+    def process_unchanged(self, url, res):
+        print('NOT MODIFIED', url)
+
     def keep_crawling(self):
         self.targets_lock.acquire()
-        self.targets = list(self.outerdomaintargets[list(self.outerdomaintargets.keys())[0]])
-        self.seen = set(self.targets)
-        del self.outerdomaintargets[list(self.outerdomaintargets.keys())[0]]
+        urls = self.frontier.restart(self.frontier.pop_outer())
         self.targets_lock.release()
-        self.root_url = self.targets.pop()
-        self.crawl(self.root_url)
+        # Websites whose URLs were all visited before are skipped
+        if urls:
+            self.root_url = urls[-1]
+            if self.use_sitemaps:
+                self._set_root(self.root_url)
+                self._seed_sitemaps(self.root_url)
+            self.crawl(self.root_url)
+
+    def _prepare(self, url):
+        self.root_url = url
+
+        # In a sharded crawling, the URLs of any domain can arrive at any time
+        if self.follow_mode == self.F_TLD and (self.maxdomains > 1 or self.shard is not None):
+            # Every domain of the TLD is queued separately and crawled at the same time
+            self.domains = DomainScheduler(self.frontier, self.maxdomains,
+                max(1, self.max_outstanding // self.maxdomains))
+            self.frontier.key = self._target_domain
 
     def init_crawling(self, url):
-        self.root_url = url
+        self._prepare(url)
 
-        self.targets.append(url)
-        self.seen.add(url)
-        self.crawl(url)
+        self.targets_lock.acquire()
+        self.frontier.add(url)
+        self.targets_lock.release()
 
+        if self.use_sitemaps:
+            self._set_root(url)
+            self._seed_sitemaps(url)
+        if self.validators:
+            # The pages of the previous crawling are checked again even if no changed page links them
+            self._set_root(url)
+            for previous in self.validators:
+                self._add_target(self._follow_link(previous, previous))
+        self.crawl(url)
 
-    def crawl(self, url):
-        rx = re.match('(https?://)([^/]+)([^\?]*)(\?.*)?', url)
+    def run_shard(self, shard, url):
+        """Crawls the hosts of shard until the coordinator stops it: once the
+        frontier is empty, the process waits for URLs found by the others.
+        The process that owns url starts the crawling. Once stopped, the URLs
+        sent by the others before they stopped too are still queued, so they
+        are kept in the saved status.
+        """
+        self.shard = shard
+        inbox = Thread(target=self._shard_inbox)
+        inbox.daemon = True
+        inbox.start()
+        monitor = Thread(target=self._shard_monitor)
+        monitor.daemon = True
+        monitor.start()
+        if shard.owns(url):
+            self.init_crawling(url)
+        else:
+            self._prepare(url)
+        while not self.interrupt:
+            # The count of URLs received is taken with the frontier, so the
+            # coordinator does not take URLs still to be crawled for finished
+            self.targets_lock.acquire()
+            received = shard.received
+            pending = len(self.frontier) > 0
+            self.targets_lock.release()
+            if pending:
+                shard.idle = False
+                self.crawl(self.root_url)
+            else:
+                shard.idle = True
+                shard.report(received, self.crawlsize)
+                shard.wakeup.wait(0.5)
+                shard.wakeup.clear()
+        shard.results.put(('stopped', shard.index))
+        inbox.join()
+
+    def _shard_inbox(self):
+        while True:
+            message = self.shard.inbox.get()
+            if message is None:
+                break
+            self.targets_lock.acquire()
+            if self.frontier.add(message[0], message[1]):
+                self._prefetch(message[0])
+                self.work.notify()
+            self.shard.received += 1
+            self.targets_lock.release()
+            self.shard.wakeup.set()
+
+    def _shard_monitor(self):
+        # The coordinator enforces the size and time limits of the whole crawling
+        while not self.shard.stop.wait(0.5):
+            if not self.shard.idle:
+                self.shard.report(self.shard.received, self.crawlsize)
+        self.interrupt = True
+        self.shard.wakeup.set()
+
+    def _seed_sitemaps(self, url):
+        """Queues the URLs in the sitemaps of the website of url: those listed
+        in its robots.txt or, if there are none, /sitemap.xml. In a re-crawl,
+        the pages whose lastmod is newer than their previous download are
+        queued first and those that did not change, last.
+        """
+        parser = self.robots.get(url) or self.robots.fetch(url)
+        sitemaps = parser.site_maps() or [self.robots.origin(url) + "/sitemap.xml"]
+        count = 0
+        for loc, lastmod, alternates in SitemapReader(self.timeout).urls(sitemaps):
+            target = self._follow_link(loc, loc)
+            if not target:
+                continue
+            boost = 0
+            if self.validators and target in self.validators and lastmod:
+                previous = self.validators[target][2]
+                try:
+                    modified = datetime.datetime.fromisoformat(lastmod.replace('Z', '+00:00'))
+                    if modified.tzinfo is None:
+                        modified = modified.replace(tzinfo=datetime.timezone.utc)
+                    previous = datetime.datetime.strptime(previous, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=datetime.timezone.utc)
+                    boost = 1 if modified > previous else -1
+                except (TypeError, ValueError):
+                    pass
+            # A page with a version in one of the languages is likely to be a translation
+            hreflang = None
+            for lang, _ in alternates:
+                if self.languages and lang.replace('_', '-').split('-')[0].lower() in self.languages:
+                    hreflang = lang
+            self._add_target(target, hreflang, boost)
+            for lang, alternate in alternates:
+                self._add_target(self._follow_link(loc, alternate), lang)
+            count += 1
+        sys.stderr.write("Read "+str(count)+" URLs from the sitemaps of "+self.robots.origin(url)+"\n")
+
+    def _set_root(self, url):
+        rx = URL_RX.match(url)
         if rx is None:
           url="http://"+url
-          rx = re.match('(https?://)([^/]+)([^\?]*)(\?.*)?', url)
+          rx = URL_RX.match(url)
+        # The port is left out, as in the hosts of the links it is compared to
         self.proto = rx.group(1)
         self.host = rx.group(2)
-        self.path = rx.group(3)
+        self.path = rx.group(4)
         self.dir_path = dirname(self.path)
-        self.query = rx.group(4)
+        self.query = rx.group(5)
 
         self.TLdomain = self.host.split(".")[-1]
         self.currdomain = self._url_domain(self.host)
 
-        try:
-          self.robotsparser.set_url(self.proto+self.host+"/robots.txt")
-          self.robotsparser.read()
-        except IOError:
-          sys.stderr.write("It was not possible to connect to the web server specified to retrieve the robots.txt file")
-        except CertificateError:
-          sys.stderr.write("Certificate error: ")
-          sys.stderr.write(str(sys.exc_info()[0])+"\n")
-
-        self._spawn_new_worker()
+    def crawl(self, url):
+        self._set_root(url)
+        if self.scheduler is None:
+            self.scheduler = HostScheduler(self.delay, self.robots)
+        self.scheduler.robots = self.robots
+
+        if self.use_asyncio:
+            asyncio.run(self._async_crawl())
+            return
+
+        # A fixed pool of workers: they wait for URLs while downloads are in
+        # progress and all of them end once the crawling is over
+        self.fetching = 0
+        workers = []
+        for _ in range(self.max_outstanding):
+            t = Thread(target=self._worker)
+            t.daemon = True
+            t.start()
+            workers.append(t)
         if self.verbose:
-          sys.stderr.write("Starting thread\n")
+          sys.stderr.write("Started "+str(len(workers))+" threads\n")
 
-        while self.threads:
-            try:
-                for t in self.threads:
-                    try:
-                        t.join(1)
-                        if not t.isAlive():
-                            self.threads.remove(t)
-                            if self.verbose:
-                              sys.stderr.write("Killing thread\n")
-                    except RuntimeError:
-                        pass
+        try:
+            for t in workers:
+                t.join()
+        except KeyboardInterrupt:
+            sys.exit(1)
 
-            except KeyboardInterrupt:
-                sys.exit(1)
+        self.connections.close()
 
     def _url_domain(self, host):
         parts = host.split('.')
         if len(parts) <= 2:
             return host
-        elif re.match('^[0-9]+(?:\.[0-9]+){3}$', host): # IP
+        elif IP_RX.match(host): # IP
             return host
         else:
             return '.'.join(parts[1:])
 
-    def _follow_link(self, url, link):
+    def _target_domain(self, url):
+        rx = re.match('https?://([^/:]+)', url)
+        return self._url_domain(rx.group(1)) if rx else None
+
+    def _next_target(self):
+        # Must be called with targets_lock held
+        if self.domains is None:
+            return self.frontier.pop()
+        return self.domains.next()
+
+    def _next_available(self):
+        """Returns the next URL to be downloaded whose host can take a request
+        now, or None. The URLs of the hosts that already have as many requests
+        in progress as the scheduler allows are put back in the frontier, so
+        the workers do not wait for a busy host while others are idle. Must be
+        called with targets_lock held.
+        """
+        skipped = []
+        url = self._next_target()
+        while url is not None and not self.scheduler.available(re.match('https?://([^/]+)', url).group(1)):
+            skipped.append(url)
+            url = self._next_target() if len(skipped) < self.MAX_SKIPPED else None
+        # They are put back in the same order they had
+        for skipped_url in reversed(skipped):
+            self.frontier.putback(skipped_url, self._priority(skipped_url))
+            if self.domains is not None:
+                self.domains.done(skipped_url)
+        return url
+
+    def _target_done(self, url):
+        if self.domains is not None:
+            self.targets_lock.acquire()
+            self.domains.done(url)
+            self.targets_lock.release()
+
+    def _can_fetch(self, url):
+        return self.robots.can_fetch(url)
+
+    async def _async_can_fetch(self, url):
+        """Checks url against the robots.txt of its host; when it has to be
+        downloaded, the request is sent from the event loop and the other
+        URLs of the host wait for it.
+        """
+        parser = self.robots.get(url)
+        if parser is None:
+            origin = self.robots.origin(url)
+            if origin not in self.robots_pending:
+                self.robots_pending[origin] = asyncio.ensure_future(self._async_fetch_robots(origin))
+            try:
+                parser = await asyncio.shield(self.robots_pending[origin])
+            finally:
+                if self.robots_pending.get(origin) is not None and self.robots_pending[origin].done():
+                    del self.robots_pending[origin]
+        return parser.can_fetch("*", url)
+
+    async def _async_fetch_robots(self, origin):
+        url = origin + "/robots.txt"
+        try:
+            # Redirects are followed, up to 5 of them
+            for _ in range(5):
+                rx = re.match('(https?)://([^/]+)(.*)', url)
+                res = await asyncio.wait_for(self._async_get(rx.group(1), rx.group(2), rx.group(3), {'Accept-Encoding': BodyDecoder.accept_encoding()}), self.timeout)
+                try:
+                    location = res.getheader('Location')
+                    if res.status < 300 or res.status >= 400 or location is None:
+                        await asyncio.wait_for(res.load(self.robots.max_size), self.timeout)
+                        break
+                finally:
+                    res.close()
+                url = urllib.parse.urljoin(url, location)
+            if res.status >= 300 and res.status < 400:
+                return self.robots.store(origin, 404, [])
+            return self.robots.store(origin, res.status, res.read().decode("utf-8", "replace").splitlines())
+        except (http.client.HTTPException, EnvironmentError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError, AttributeError, DocumentTooLarge):
+            return self.robots.store(origin, None, [])
+
+    def _url_base(self, url):
+        rx = URL_RX.match(url)
+        url_proto = rx.group(1)
+        url_host = rx.group(2)
+        url_port = rx.group(3) if rx.group(3) else ''
+        url_path = rx.group(4) if len(rx.group(4)) > 0 else '/'
+        return url_proto, url_host, url_port, url_path, dirname(url_path)
+
+    def _follow_link(self, url, link, base=None):
+        """Resolves a link found in url and returns the URL to be crawled, or
+        None if it must not be followed. base can be given with the result of
+        _url_base(url) when several links of the same document are resolved.
+        """
         #Longer than limit set by the standard RFC7230 are discarded
         if len(link) > 2000:
             return None
 
         # Remove anchor
-        link = re.sub(r'#[^#]*$', '', link)
+        if '#' in link:
+            link = ANCHOR_RX.sub('', link)
 
-        # Skip prefix
-        if re.search(self.prefix_filter, link):
+        # Skip prefix and filter url: all the patterns are matched at once
+        if self.link_filter is None:
+            self.link_filter = re.compile('|'.join('(?:%s)' % f for f in [self.prefix_filter] + self.url_filters))
+        if self.link_filter.search(link):
             return None
 
-        # Filter url
-        for f in self.url_filters:
-            if re.search(f, link):
-                return None
+        if base is None:
+            base = self._url_base(url)
+        url_proto, url_host, url_port, url_path, url_dir_path = base
 
-        rx = re.match('(https?://)([^/:]+)(:[0-9]+)?([^\?]*)(\?.*)?', url)
-        url_proto = rx.group(1)
-        url_host = rx.group(2)
-        url_port = rx.group(3) if rx.group(3) else ''
-        url_path = rx.group(4) if len(rx.group(4)) > 0 else '/'
-        url_dir_path = dirname(url_path)
-
-        rx = re.match('((https?://)([^/:]+)(:[0-9]+)?)?([^\?]*)(\?.*)?', link)
+        rx = LINK_RX.match(link)
         link_full_url = rx.group(1) != None
         link_proto = rx.group(2) if rx.group(2) else url_proto
         link_host = rx.group(3) if rx.group(3) else url_host
@@ -214,7 +2015,9 @@ class Crawler(object):
 
         if not link_full_url and not link.startswith('/'):
             link_path = normpath(join(url_dir_path, link_path))
-        link_dir_path = dirname(link_path)
+        # Characters not allowed in a URL, such as spaces or non-ASCII letters,
+        # are percent-encoded, as in the query
+        link_path = quote(link_path, "/%:@!$&'()*+,;=~")
 
         link_url = link_proto + link_host + link_port + link_path + link_query
         if self.follow_mode == self.F_ANY:
@@ -223,11 +2026,11 @@ class Crawler(object):
             dom = self._url_domain(link_host)
             if dom == self.currdomain:
                 return link_url
+            elif dom.split(".")[-1] == self.TLdomain and self.domains is not None:
+                return link_url
             elif dom.split(".")[-1] == self.TLdomain:
                 self.targets_lock.acquire()
-                if dom not in self.outerdomaintargets:
-                    self.outerdomaintargets[dom] = set()
-                self.outerdomaintargets[dom].add(link_url)
+                self.frontier.add_outer(dom, link_url)
                 self.targets_lock.release()
                 sys.stderr.write("'"+link+"' stored in the list of domains\n")
                 return None
@@ -235,13 +2038,13 @@ class Crawler(object):
                 sys.stderr.write("'"+link+"' discarded: not in the same TLD\n")
                 return None
         elif self.follow_mode == self.F_SAME_DOMAIN:
-            return link_url if self._url_domain(self.host) == \
+            return link_url if self.currdomain == \
                     self._url_domain(link_host) else None
         elif self.follow_mode == self.F_SAME_HOST:
             return link_url if self.host == link_host else None
         elif self.follow_mode == self.F_SAME_PATH:
             if self.host == link_host and \
-                    link_dir_path.startswith(self.dir_path):
+                    dirname(link_path).startswith(self.dir_path):
                 return link_url
             else:
                 return None
@@ -251,159 +2054,557 @@ class Crawler(object):
         return len(url.replace('https', 'http').replace(self.root_url, '')
                 .rstrip('/').split('/')) - 1
 
-    def _add_target(self, target):
+    def _priority(self, url, hreflang=None):
+        """Scores a URL before it is queued: links to versions of a page in
+        another language (hreflang) and URLs with a marker of one of the
+        languages in the subdomain, the path or the query come first, and
+        shallower URLs before deeper ones.
+        """
+        if self.lang_rx is None:
+            return 0
+        score = 0
+        if hreflang is not None:
+            score += 3 if hreflang.replace('_', '-').split('-')[0].lower() in self.languages else 1
+        rx = URL_RX.match(url)
+        if rx is None:
+            return score
+        path = rx.group(4) or '/'
+        # The top level domain is left out, so example.fr is not taken as French
+        if self.lang_rx.search('/' + rx.group(2).rsplit('.', 1)[0] + path + (rx.group(5) or '')):
+            score += 2
+        return score - 0.1 * path.rstrip('/').count('/')
+
+    def _add_target(self, target, hreflang=None, boost=0):
         if not target:
             return
 
         if self.max_depth and self._calc_depth(target) > self.max_depth:
             return
 
+        priority = self._priority(target, hreflang) + boost
+        if self.traps is not None:
+            penalty = self.traps.penalty(target)
+            if penalty is None:
+                return
+            priority += penalty
         self.targets_lock.acquire()
-        if target in self.visited:
-            self.targets_lock.release()
-            return
-        if target not in self.seen:
-            self.targets.append(target)
-            self.seen.add(target)
+        if self.shard is not None and not self.shard.owns(target):
+            self.shard.route(target, priority)
+        elif self.frontier.add(target, priority):
+            self._prefetch(target)
+            self.work.notify()
         self.targets_lock.release()
 
-    def _spawn_new_worker(self):
+    def _prefetch(self, url):
+        # The host is resolved while the URL waits in the frontier
+        rx = URL_RX.match(url)
+        if rx is not None:
+            self.dns.prefetch(rx.group(2))
+
+    def _header_bytes(self, res):
+        # Size of the status line and the headers of a response
+        return 15 + len(res.reason) + sum(len(name) + len(value) + 4 for name, value in res.getheaders())
+
+    def _count_bytes(self, size):
         self.concurrency_lock.acquire()
+        self.crawlsize += size/1000000.0
+        self.concurrency_lock.release()
+
+    def _too_large(self, res):
+        # Documents whose length is known are discarded before reading them
+        length = res.getheader('Content-Length')
         try:
-            self.concurrency += 1
-            t = Thread(target=self._worker, args=(self.concurrency,))
-            t.daemon = True
-            self.threads.append(t)
-            t.start()
+            return self.max_document_size is not None and length is not None and int(length) > self.max_document_size
+        except ValueError:
+            return False
+
+    def _read_body(self, res):
+        """Reads the body of a response of http.client in chunks and
+        decompresses it, so DocumentTooLarge is raised as soon as it goes
+        over the maximum size of a document. Returns the body and the number
+        of bytes received.
+        """
+        decoder = BodyDecoder(res.getheader('Content-Encoding'), self.max_document_size)
+        chunks = []
+        size = 0
+        while True:
+            chunk = res.read(65536)
+            if not chunk:
+                chunks.append(decoder.flush())
+                break
+            size += len(chunk)
+            chunks.append(decoder.decompress(chunk))
+            if self.max_document_size is not None and max(size, decoder.size) > self.max_document_size:
+                raise DocumentTooLarge(size)
+        return b''.join(chunks), size
+
+    def _conditional_headers(self, url):
+        """Headers of the request of a page: the compressed encodings
+        accepted and those that make the server answer 304 Not Modified if
+        the page did not change since the previous crawling.
+        """
+        headers = {'Accept-Encoding': BodyDecoder.accept_encoding()}
+        if not self.validators or url not in self.validators:
+            return headers
+        etag, modified, _ = self.validators[url]
+        if etag:
+            headers['If-None-Match'] = etag
+        if modified:
+            headers['If-Modified-Since'] = modified
+        return headers
+
+    def _adaptive(self):
+        return isinstance(self.scheduler, AdaptiveHostScheduler)
+
+    def _wait_turn(self, host):
+        """Blocks the calling worker until a request can be sent to host. By
+        default the requests to every host are spaced by the delay set with
+        -T; with an adaptive scheduler every host has its own delay and
+        number of requests in progress.
+        """
+        wait = self.scheduler.reserve(host)
+        while wait is None:
+            time.sleep(0.1)
+            wait = self.scheduler.reserve(host)
+        time.sleep(wait)
+
+    def _turn_done(self, host, latency=None, res=None):
+        if res is None:
+            self.scheduler.done(host)
+        else:
+            self.scheduler.done(host, latency, res.status, res.getheader('Retry-After'))
+
+    def _putback(self, url):
+        # The crawling stopped before url was downloaded; it is kept for a later continuation
+        self.targets_lock.acquire()
+        self.frontier.putback(url, self._priority(url))
+        self.targets_lock.release()
+
+    def _retry(self, url, e):
+        self.targets_lock.acquire()
+        attempt = self.frontier.retry(url, priority=self._priority(url))
+        self.metrics.retry(attempt is None)
+        if attempt is not None:
+          logging.error('%s: %s, retrying (attempt %s)' % (url, str(e), str(attempt)))
+        else:
+          logging.error('%s: %s, given up after 5 attempts' % (url, str(e)))
+        self.targets_lock.release()
+
+    def _give_up(self, url, e):
+        # Unexpected errors, such as a URL that http.client cannot encode,
+        # would happen again, so the URL is not retried
+        self.metrics.retry(True)
+        logging.error('%s: %s, given up' % (url, repr(e)))
+
+    def _extract_links(self, doc):
+        # Make unique list (these are the links in the document); links are
+        # searched in the raw bytes, so only the links have to be decoded
+        linksset = []
+        for link in set(HREF_RX.findall(doc.text)):
+            try:
+                linksset.append(link.decode('utf8').strip())
+            except UnicodeDecodeError:
+                linksset.append(link.decode('latin1').strip())
+        random.shuffle(linksset)
+        return linksset
+
+    def _is_trap(self, url):
+        # URLs queued before their pattern was found to be a trap are skipped
+        if self.traps is not None and self.traps.pruned(url):
+            sys.stderr.write(url+" discarded: crawler trap\n")
+            return True
+        return False
+
+    def _process(self, url, doc):
+        self.metrics.document()
+        linksset = self._extract_links(doc)
+        if self.traps is not None and self.traps.add(url, doc.text):
+            sys.stderr.write(url+" discarded: near-duplicate of a document already downloaded\n")
+        else:
+            self.process_document(doc)
+        self._follow_links(url, linksset, self._extract_alternates(doc))
+
+    def _extract_alternates(self, doc):
+        # Links to the versions of the document in other languages, and their languages
+        alternates = {}
+        if self.lang_rx is None:
+            return alternates
+        for tag in HREFLANG_RX.finditer(doc.text):
+            href = TAG_HREF_RX.search(tag.group(0))
+            if href:
+                try:
+                    link = href.group(1).decode('utf8').strip()
+                except UnicodeDecodeError:
+                    link = href.group(1).decode('latin1').strip()
+                alternates[link] = tag.group(1).decode('ascii')
+        return alternates
+
+    def _follow_links(self, url, links, alternates=None):
+        base = self._url_base(url)
+        for link in links:
+            self._add_target(self._follow_link(url, link, base), alternates.get(link) if alternates else None)
+
+    def _next_url(self):
+        """Blocks until there is a URL to be crawled and returns it, or returns
+        None once the crawling is over: when it was interrupted, or when the
+        frontier is empty and no download in progress can add URLs to it.
+        """
+        self.targets_lock.acquire()
+        try:
+            while not self.interrupt:
+                url = self._next_available() if self.frontier else None
+                if url is not None:
+                    self.fetching += 1
+                    return url
+                if not self.frontier and self.fetching == 0:
+                    self.work.notify_all()
+                    return None
+                # The URLs left belong to busy domains, or those being
+                # downloaded may add new ones
+                self.work.wait(0.5)
+            return None
         finally:
-            self.concurrency_lock.release()
+            self.targets_lock.release()
 
-    def _worker(self, _):
-        while self.targets:
-            if self.interrupt:
+    def _fetch_done(self):
+        self.targets_lock.acquire()
+        self.fetching -= 1
+        self.work.notify_all()
+        self.targets_lock.release()
+
+    def _worker(self):
+        while True:
+            if self.timelimit != None and time.time()-self.crawlstarts > self.timelimit:
+                self.interrupt=True
+            url = self._next_url()
+            if url is None:
                 break
-            else:
-                url = None
-                self.targets_lock.acquire()
-                if len(self.targets)>0:
-                    url = self.targets.pop()
-                    if url not in self.visited:
-                        self.visited[url] = 1
-                self.targets_lock.release()
+            conn = None
+            host = None
+            self.metrics.fetch_started()
+            try:
+                logging.debug('url: %s' % url)
 
-                if url != None:
+                if self._is_trap(url):
+                    pass
+                elif not self._can_fetch(url):
+                    sys.stderr.write("robots.txt forbids crawling URL: "+url+"\n")
+                else:
+                    if self.verbose:
+                      sys.stderr.write("Crawling URL: "+url+"\n")
+
+                    rx = re.match('(https?)://([^/]+)(.*)', url)
+                    protocol = rx.group(1)
+                    path = rx.group(3)
+
+                    #Connections are done with a delay to avoid blocking the server
+                    self._wait_turn(rx.group(2))
+                    host = rx.group(2)
+                    start = time.time()
+                    conn, res = self.connections.request(protocol, host, path, self._conditional_headers(url))
+                    latency = time.time() - start
+                    self._count_bytes(self._header_bytes(res))
+                    self.metrics.response(host, latency, res.status)
+
+                    if res.status == 304:
+                        self._count_bytes(self.connections.discard(conn, res))
+                        conn = None
+                        self._turn_done(host, latency, res)
+                        host = None
+                        self.process_unchanged(url, res)
+                        continue
+
+                    if res.status >= 301 and res.status <= 308:
+                        rlink = self._follow_link(url, res.getheader('location'))
+                        self._add_target(rlink)
+                        logging.info('redirect: %s -> %s' % (url, rlink))
+                        self._count_bytes(self.connections.discard(conn, res))
+                        conn = None
+                        self._turn_done(host, latency, res)
+                        host = None
+                        continue
+
+                    if res.status in (429, 503) and self._adaptive():
+                        # The server asked to slow down: the URL is tried again later
+                        self._count_bytes(self.connections.discard(conn, res))
+                        conn = None
+                        self._turn_done(host, latency, res)
+                        host = None
+                        self._retry(url, http.client.HTTPException("%d %s" % (res.status, res.reason)))
+                        continue
+
+                    # Check content type
+                    try:
+                        if not re.search(self.content_type_filter,
+                            res.getheader('Content-Type')):
+                            sys.stderr.write(url+" discarded: wrong file type\n")
+                            self._count_bytes(self.connections.discard(conn, res))
+                            conn = None
+                            self._turn_done(host, latency, res)
+                            host = None
+                            continue
+                    except TypeError: # getheader result is None
+                        self._count_bytes(self.connections.discard(conn, res))
+                        conn = None
+                        self._turn_done(host, latency, res)
+                        host = None
+                        continue
+
+                    if self._too_large(res):
+                        sys.stderr.write(url+" discarded: larger than the maximum document size\n")
+                        self._count_bytes(self.connections.discard(conn, res))
+                        conn = None
+                        self._turn_done(host, latency, res)
+                        host = None
+                        continue
                     try:
-                        logging.debug('url: %s' % url)
-
-                        if not self.robotsparser.can_fetch("*", url):
-                            sys.stderr.write("robots.txt forbids crawling URL: "+url+"\n")
-                        else:
-                            if self.verbose:
-                              sys.stderr.write("Crawling URL: "+url+"\n")
-
-                            rx = re.match('(https?)://([^/]+)(.*)', url)
-                            protocol = rx.group(1)
-                            host = rx.group(2)
-                            path = rx.group(3)
-
-                            #Connections are done with a delay to avoid blocking the server
-                            self.delay_lock.acquire()
-                            if protocol == 'http':
-                                conn = http.client.HTTPConnection(host, timeout=self.timeout)
-                            else:
-                                conn = http.client.HTTPSConnection(host, timeout=self.timeout)
-
-                            conn.request('GET', path)
-                            res = conn.getresponse()
-
-                            if res.status >= 301 and res.status <= 308:
-                                rlink = self._follow_link(url, res.getheader('location'))
-                                self._add_target(rlink)
-                                logging.info('redirect: %s -> %s' % (url, rlink))
-                                conn.close()
-                                time.sleep(self.delay)
-                                self.delay_lock.release()
-                                continue
-
-                            # Check content type
-                            try:
-                                if not re.search(self.content_type_filter,
-                                    res.getheader('Content-Type')):
-                                    sys.stderr.write(url+" discarded: wrong file type\n")
-                                    conn.close()
-                                    time.sleep(self.delay)
-                                    self.delay_lock.release()
-                                    continue
-                            except TypeError: # getheader result is None
-                                conn.close()
-                                time.sleep(self.delay)
-                                self.delay_lock.release()
-                                continue
-
-                            doc = Document(res, url)
-                            conn.close()
-                            time.sleep(self.delay)
-                            self.delay_lock.release()
-
-
-                            # Make unique list (these are the links in the document)
-                            try:
-                                links = re.findall("href\s*=\s*['\"]\s*([^'\"]+)['\"]", doc.text.decode('utf8'))
-                                #content = re.sub('<atom:link[^>]*>', '', doc.text.decode('utf8'))
-                            except:
-                                links = re.findall("href\s*=\s*['\"]\s*([^'\"]+)['\"]", doc.text.decode('latin1'))
-
-                                #content = re.sub('<atom:link[^>]*>', '', doc.text.decode('latin1'))
-
-                                #sys.stderr.write(str(content)+"\n")
-
-                                #content = re.sub('<head>.*</head>', '', content)
-                                #links = re.findall("href\s*=\s*['\"]\s*([^'\"]+)['\"]",
-                                #      content)
-
-                            linksset = list(set(links))
-                            random.shuffle(linksset)
-                            self.process_document(doc)
-
-                            for link in linksset:
-                                rlink = self._follow_link(url, link.strip())
-                                self._add_target(rlink)
-
-                            if self.concurrency < self.max_outstanding:
-                                if self.verbose:
-                                    sys.stderr.write("Starting thread\n")
-                                    self._spawn_new_worker()
-
-                    except (http.client.HTTPException, EnvironmentError) as e:
-                        time.sleep(self.delay)
-                        self.delay_lock.release()
-
-                        if self.sizelimit != None and self.crawlsize > self.sizelimit:
-                            self.concurrency_lock.acquire()
-                            self.interrupt=True
-                            self.concurrency_lock.release()
-                        elif self.timelimit != None and time.time()-self.crawlstarts > self.timelimit:
-                            self.concurrency_lock.acquire()
-                            self.interrupt=True
-                            self.concurrency_lock.release()
-                        else:
-                            self.targets_lock.acquire()
-                            if self.visited[url] <= 5:
-                              logging.error('%s: %s, retrying (attempt %s)' % (url, str(e), str(self.visited[url])))
-                              self.targets.append(url)
-                              self.visited[url]=self.visited[url]+1
-                              self.seen.add(url)
-                            else:
-                              logging.error('%s: %s, given up after 5 attempts' % (url, str(e)))
-                            self.targets_lock.release()
+                        text, size = self._read_body(res)
+                    except DocumentTooLarge as e:
+                        sys.stderr.write(url+" discarded: larger than the maximum document size\n")
+                        self._count_bytes(e.size)
+                        self._turn_done(host, latency, res)
+                        host = None
+                        continue
+                    self._count_bytes(size)
+
+                    doc = Document(res, url, text)
+                    self.connections.release(conn, res)
+                    conn = None
+                    self._turn_done(host, latency, res)
+                    host = None
+
+
+                    self._process(url, doc)
+
+            except (http.client.HTTPException, EnvironmentError) as e:
+                if conn is not None:
+                    conn.close()
+                if host is not None:
+                    self._turn_done(host)
+                    host = None
+
+                if self.sizelimit != None and self.crawlsize > self.sizelimit:
+                    self.concurrency_lock.acquire()
+                    self.interrupt=True
+                    self.concurrency_lock.release()
+                elif self.timelimit != None and time.time()-self.crawlstarts > self.timelimit:
+                    self.concurrency_lock.acquire()
+                    self.interrupt=True
+                    self.concurrency_lock.release()
                 else:
-                    self.targets_lock.release()
-            if crawler.timelimit != None and time.time()-crawler.crawlstarts > crawler.timelimit:
+                    self._retry(url, e)
+            except Exception as e:
+                # The worker goes on with the next URL, so the pool is kept at -j
+                self._give_up(url, e)
+            finally:
+                if conn is not None:
+                    conn.close()
+                if host is not None:
+                    self._turn_done(host)
+                self._target_done(url)
+                self._fetch_done()
+                self.metrics.fetch_done()
+
+    async def _async_crawl(self):
+        """Asyncio crawling engine: a single thread keeps up to max_outstanding
+        requests in flight, while the delay between requests is applied to each
+        host separately.
+        """
+        self.robots_pending = {}
+        self.ssl_context = ssl.create_default_context()
+        pending = set()
+        while not self.interrupt:
+            self.targets_lock.acquire()
+            while self.frontier and len(pending) < self.max_outstanding:
+                url = self._next_available()
+                if url is None:
+                    break
+                pending.add(asyncio.ensure_future(self._async_worker(url)))
+            self.targets_lock.release()
+
+            if not pending:
+                if not self.frontier:
+                    break
+                # The URLs left belong to domains that are not active yet, as
+                # in _next_url
+                await asyncio.sleep(0.1)
+            else:
+                # Waits are bounded, so new domains are activated while the
+                # downloads of the others are in progress
+                done, pending = await asyncio.wait(pending, timeout=0.5, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        logging.error('worker failed: %s' % str(task.exception()))
+
+            if self.timelimit != None and time.time()-self.crawlstarts > self.timelimit:
                 self.interrupt=True
 
-        self.concurrency_lock.acquire()
-        self.concurrency -= 1
-        self.concurrency_lock.release()
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+
+    async def _async_worker(self, url):
+        self.metrics.fetch_started()
+        try:
+            await self._async_fetch(url)
+        except Exception as e:
+            self._give_up(url, e)
+        finally:
+            self._target_done(url)
+            self.metrics.fetch_done()
+
+    async def _async_fetch(self, url):
+        logging.debug('url: %s' % url)
+
+        if self._is_trap(url):
+            return
+        if not await self._async_can_fetch(url):
+            sys.stderr.write("robots.txt forbids crawling URL: "+url+"\n")
+            return
+
+        rx = re.match('(https?)://([^/]+)(.*)', url)
+        protocol = rx.group(1)
+        host = rx.group(2)
+        path = rx.group(3)
+
+        reserved = False
+        res = None
+        try:
+            #Connections to the same host are done with a delay to avoid blocking the server
+            wait = self.scheduler.reserve(host)
+            while wait is None:
+                await asyncio.sleep(0.1)
+                wait = self.scheduler.reserve(host)
+            reserved = True
+            await asyncio.sleep(wait)
+            if self.interrupt:
+                self._putback(url)
+                return
+            if self.verbose:
+                sys.stderr.write("Crawling URL: "+url+"\n")
+
+            start = time.time()
+            res = await asyncio.wait_for(self._async_get(protocol, host, path, self._conditional_headers(url)), self.timeout)
+        except asyncio.CancelledError:
+            self._putback(url)
+            raise
+        except (http.client.HTTPException, EnvironmentError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            if self.sizelimit != None and self.crawlsize > self.sizelimit:
+                self.interrupt=True
+            elif self.timelimit != None and time.time()-self.crawlstarts > self.timelimit:
+                self.interrupt=True
+            else:
+                self._retry(url, e)
+            return
+        finally:
+            if reserved:
+                if res is None:
+                    self.scheduler.done(host)
+                else:
+                    self.scheduler.done(host, time.time()-start, res.status, res.getheader('Retry-After'))
+
+        self._count_bytes(self._header_bytes(res))
+        self.metrics.response(host, time.time()-start, res.status)
+        try:
+            await self._async_process(url, res)
+        finally:
+            res.close()
+
+    async def _async_process(self, url, res):
+        if res.status in (429, 503) and self._adaptive():
+            # The server asked to slow down: the URL is tried again later
+            self._retry(url, http.client.HTTPException("%d %s" % (res.status, res.reason)))
+            return
+
+        if res.status == 304:
+            self.process_unchanged(url, res)
+            return
+
+        if res.status >= 301 and res.status <= 308:
+            location = res.getheader('location')
+            if location:
+                rlink = self._follow_link(url, location)
+                self._add_target(rlink)
+                logging.info('redirect: %s -> %s' % (url, rlink))
+            return
+
+        # Check content type
+        content_type = res.getheader('Content-Type')
+        if content_type is None:
+            return
+        if not re.search(self.content_type_filter, content_type):
+            sys.stderr.write(url+" discarded: wrong file type\n")
+            return
+
+        if self._too_large(res):
+            sys.stderr.write(url+" discarded: larger than the maximum document size\n")
+            return
+        try:
+            await asyncio.wait_for(res.load(self.max_document_size), self.timeout)
+        except DocumentTooLarge:
+            sys.stderr.write(url+" discarded: larger than the maximum document size\n")
+            return
+        except (http.client.HTTPException, EnvironmentError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+            self._retry(url, e)
+            return
+        finally:
+            self._count_bytes(res.length)
+
+        doc = Document(res, url)
+        self._process(url, doc)
+
+    async def _async_get(self, protocol, host, path, headers={}):
+        """Sends a GET request through an asyncio stream and reads the status
+        line and the headers of the response, following the same wire format
+        as http.client; the body is read with AsyncResponse.load().
+        """
+        if ':' in host:
+            hostname, port = host.rsplit(':', 1)
+            port = int(port)
+        else:
+            hostname = host
+            port = 80 if protocol == 'http' else 443
+        try:
+            host_header = host.encode('ascii')
+        except UnicodeEncodeError:
+            host_header = host.encode('idna')
+
+        error = None
+        for _, address in await self.dns.async_resolve(hostname):
+            try:
+                reader, writer = await asyncio.open_connection(address, port,
+                    ssl=self.ssl_context if protocol == 'https' else None,
+                    server_hostname=hostname if protocol == 'https' else None)
+                break
+            except OSError as e:
+                error = e
+        else:
+            raise error
+        # The connection is closed by the response once it is processed
+        try:
+            writer.write(b'GET ' + (path or '/').encode('ascii') + b' HTTP/1.1\r\n' +
+                b'Host: ' + host_header + b'\r\n' +
+                b''.join(name.encode('ascii') + b': ' + value.encode('latin1') + b'\r\n' for name, value in headers.items()) +
+                b'Connection: close\r\n\r\n')
+            await writer.drain()
+
+            statusline = (await reader.readline()).decode('iso-8859-1').split(None, 2)
+            if len(statusline) < 2 or not statusline[0].startswith('HTTP/'):
+                raise http.client.BadStatusLine(' '.join(statusline))
+            status = int(statusline[1])
+            reason = statusline[2].strip() if len(statusline) > 2 else ''
+            head = []
+            while True:
+                line = await reader.readline()
+                head.append(line)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            msg = http.client.parse_headers(io.BytesIO(b''.join(head)))
+            return AsyncResponse(status, reason, msg, reader, writer)
+        except:
+            writer.close()
+            raise
 
 
 
@@ -412,27 +2613,64 @@ class Crawler(object):
 oparser = argparse.ArgumentParser(description="Script that crawls a website and prints the downloaded documents in standard output using WARC format.")
 oparser.add_argument("URL", metavar="FILE", nargs="?", help="URL of the website to be downloaded", default=None)
 oparser.add_argument("-t", help="Time limit after which crawling will be stopped", dest="timelimit", required=False, default=None)
-oparser.add_argument("-s", help="Total size limit; once it is reached the crawling will be stopped", dest="sizelimit", required=False, default=None)
+oparser.add_argument("-s", help="Total size limit, counting every byte downloaded; once it is reached the crawling will be stopped", dest="sizelimit", required=False, default=None)
 oparser.add_argument("-j", help="Number of crawling jobs that can be run in parallel (threads)", dest="jobs", required=False, default=8, type=int)
 oparser.add_argument("-o", help="Timeout limit for a connexion in seconds", dest="timeout", required=False, default=8, type=int)
 oparser.add_argument("-d", help="Dump crawling status if program is stopped by SIGTERM", dest="dump", required=False, default=None)
-oparser.add_argument("-T", help="Time delay between requests in seconds; by default it is set to 5s", dest="delay", required=False, default=5)
+oparser.add_argument("-T", help="Time delay between requests to the same host in seconds; by default it is set to 5s", dest="delay", required=False, default=5, type=float)
 oparser.add_argument("-l", help="Continue an interrupted crawling. Load crawling status from this file", dest="load", required=False, default=None)
 oparser.add_argument("-e", help="Continue an interrupted crawling. Load ETT from this file", dest="resumeett", required=False, default=None)
 oparser.add_argument("-D", help="This option allows to run Bitextor on a mode that crawls a TLD starting from the URL provided.", dest="crawltld", action='store_true')
 oparser.add_argument("-v", help="Verbose mode.", dest="verbose", action='store_true')
+oparser.add_argument("--parallel-domains", help="Number of websites of the TLD crawled at the same time in the mode enabled with option -D; each website has its own queue of URLs and its own robots.txt rules, and they take turns to be crawled. By default, websites are crawled one after the other", dest="maxdomains", required=False, default=1, type=int)
+oparser.add_argument("--frontier", help="Keep the crawling status in this SQLite database instead of in memory; it is saved periodically and the crawling can be continued later with option -l", dest="frontier", required=False, default=None)
+oparser.add_argument("--checkpoint-interval", help="Seconds between consecutive saves of the crawling status kept with option --frontier; by default it is set to 60s", dest="checkpoint_interval", required=False, default=60, type=float)
+oparser.add_argument("--seen-filter", help="Keep the set of URLs already seen in a compact Bloom filter with this false positive rate (for example, 0.0001) instead of storing every URL; a false positive makes the crawler skip a URL that was never downloaded. Ignored with option --frontier", dest="seen_error_rate", required=False, default=None, type=float)
+oparser.add_argument("--lang1", help="Language (ISO 639-1 code) of the parallel data to be found; the URLs most likely to lead to documents in --lang1 or --lang2 with a translation (language markers in the URL, hreflang links) and the shallowest ones are downloaded first", dest="lang1", required=False, default=None)
+oparser.add_argument("--lang2", help="The other language (ISO 639-1 code) of the parallel data to be found; see --lang1", dest="lang2", required=False, default=None)
+oparser.add_argument("--previous", help="WARC file (plain or gzipped) of a previous crawling of the same website; can be used several times. Its pages are downloaded only if they changed (according to their ETag and Last-Modified headers or, if not available, to the date of the previous crawling); unchanged pages are left out of the output", dest="previous", required=False, default=None, action="append")
+oparser.add_argument("--revisit-records", help="With option --previous, write a WARC revisit record for every page that did not change instead of leaving it out", dest="revisit_records", action='store_true')
+oparser.add_argument("--robots-ttl", help="Seconds after which the robots.txt of a host is downloaded again; by default it is set to 86400s (one day)", dest="robots_ttl", required=False, default=86400, type=float)
+oparser.add_argument("--dns-ttl", help="Seconds during which the address of a host is cached; by default it is set to 300s", dest="dns_ttl", required=False, default=300, type=float)
+oparser.add_argument("--sitemaps", help="Before crawling a website, queue the URLs in its sitemaps (those listed in robots.txt or, if none, /sitemap.xml), including sitemap indexes and gzipped sitemaps, with their hreflang alternates", dest="use_sitemaps", action='store_true')
+oparser.add_argument("--max-document-size", help="Documents larger than this size are discarded without downloading them completely, as a number and a unit (for example, 5M); by default it is set to 20M", dest="maxdocsize", required=False, default="20M")
+oparser.add_argument("--detect-traps", help="Leave out of the output the documents that are near-duplicates of others already downloaded, and stop following the URL patterns (for example, calendars or session ids) whose documents are mostly near-duplicates", dest="detect_traps", action='store_true')
+oparser.add_argument("--autothrottle", help="Adapt the delay between requests and the number of requests in progress for each host to its response times and to the errors it returns (including 429 and 503 responses, which are retried later, and their Retry-After header). The delay set with -T is used as the initial delay", dest="autothrottle", action='store_true')
+oparser.add_argument("--min-delay", help="Minimum delay between requests to the same host in seconds with option --autothrottle; by default it is set to 0s", dest="min_delay", required=False, default=0, type=float)
+oparser.add_argument("--max-delay", help="Maximum delay between requests to the same host in seconds with option --autothrottle; by default it is set to 60s", dest="max_delay", required=False, default=60, type=float)
+oparser.add_argument("--min-host-jobs", help="Minimum number of requests in progress for the same host with option --autothrottle; by default it is set to 1", dest="min_host_jobs", required=False, default=1, type=int)
+oparser.add_argument("--max-host-jobs", help="Maximum number of requests in progress for the same host with option --autothrottle; by default it is set to 4", dest="max_host_jobs", required=False, default=4, type=int)
+oparser.add_argument("--warc-prefix", help="Write the crawled documents to gzipped WARC files named PREFIX-00000.warc.gz, PREFIX-00001.warc.gz, etc. instead of writing them, uncompressed, to the standard output", dest="warcprefix", required=False, default=None)
+oparser.add_argument("--warc-size", help="Size after which a new WARC file is started when option --warc-prefix is used, as a number and a unit (for example, 500M); by default it is set to 1G", dest="warcsize", required=False, default="1G")
+oparser.add_argument("--metrics", help="Append the metrics of the crawling (documents and bytes per second, size of the frontier, URLs seen and visited, connections, HTTP status codes, retries and response times of every host) as a JSON line to this file every --metrics-interval seconds", dest="metrics", required=False, default=None)
+oparser.add_argument("--metrics-port", help="Serve the current metrics of the crawling as JSON on this port of localhost", dest="metrics_port", required=False, default=None, type=int)
+oparser.add_argument("--metrics-interval", help="Seconds between the lines written to the file of option --metrics; by default it is set to 10s", dest="metrics_interval", required=False, default=10, type=float)
+oparser.add_argument("--processes", help="Number of crawling processes; the hosts are split among them by a hash of their name, so it speeds up crawlings of several hosts (for example, with -D) but not that of a single one. Limits -s and -t apply to the whole crawling. With --warc-prefix, process N writes the files PREFIX-N-00000.warc.gz, etc.; with --frontier, -d, -l and --metrics, the file of process N is the one given followed by .N, and process N serves its metrics on port --metrics-port plus N; by default it is set to 1", dest="processes", required=False, default=1, type=int)
+oparser.add_argument("--async", help="Use the asyncio crawling engine, in a single thread: option -j sets the number of requests in flight (hundreds can be used).", dest="use_asyncio", action='store_true')
 options = oparser.parse_args()
 
 class MyCrawler(Crawler):
+  def write_record(self, record):
+    try:
+      self.writer.write(record)
+    except Exception:
+      # The output failed: the crawling stops, and the error is raised again when the writer is closed
+      self.interrupt=True
+      raise
+
   def process_document(self, doc):
     if doc.status == 200:
+      #print base64.b64encode(doc.text)+"\t"+doc.url+"\t"+str(time.time())
+      headers={"WARC-Target-URI":doc.url}
+      # Validators used by later crawlings to download only the pages that changed
+      for name, value in doc.headers.items():
+        if name.lower() == 'etag':
+          headers['ETag']=value
+        elif name.lower() == 'last-modified':
+          headers['Last-Modified']=value
+      self.write_record(warc.WARCRecord(payload=doc.text,headers=headers))
       self.concurrency_lock.acquire()
       try:
-        #print base64.b64encode(doc.text)+"\t"+doc.url+"\t"+str(time.time())
-        warc_record = warc.WARCRecord(payload=doc.text,headers={"WARC-Target-URI":doc.url})
-        f = warc.WARCFile(fileobj=sys.stdout.buffer)
-        f.write_record(warc_record)
-        self.crawlsize+=sys.getsizeof(doc.text)/1000000.0
         if self.sizelimit != None and self.crawlsize > self.sizelimit:
           self.interrupt=True
           self.save_status()
@@ -444,16 +2682,35 @@ class MyCrawler(Crawler):
     else:
       pass
 
+  def process_unchanged(self, url, res):
+    if self.revisit_records:
+      etag, _, date = self.validators[url]
+      headers={"WARC-Type":"revisit", "WARC-Target-URI":url,
+        "WARC-Profile":"http://netpreserve.org/warc/1.0/revisit/server-not-modified"}
+      if date != None:
+        headers["WARC-Refers-To-Date"]=date
+      etag=res.getheader('ETag', etag)
+      if etag != None:
+        headers['ETag']=etag
+      if res.getheader('Last-Modified') != None:
+        headers['Last-Modified']=res.getheader('Last-Modified')
+      self.write_record(warc.WARCRecord(payload=b'',headers=headers))
+    elif self.verbose:
+      sys.stderr.write(url+" not modified since the previous crawling\n")
+
   def get_status_object(self):
-    return { 'visited':self.visited , 'targets':self.targets , 'seen':self.seen }
+    return self.frontier.get_status()
 
   def load_status(self,statusobj):
-    self.visited=statusobj['visited']
-    self.targets=statusobj['targets']
-    self.seen=statusobj['seen']
+    self.frontier.set_status(statusobj)
 
   def save_status(self):
-    if self.dumpfile != None:
+    if self.frontier.path != None:
+      sys.stderr.write("Saving crawling status to "+self.frontier.path+"\n")
+      self.targets_lock.acquire()
+      self.frontier.checkpoint()
+      self.targets_lock.release()
+    elif self.dumpfile != None:
       sys.stderr.write("Saving crawling status to "+self.dumpfile+"\n")
       pickle.dump(self.get_status_object(),open(self.dumpfile,'wb'))
 
@@ -479,23 +2736,37 @@ crawler = MyCrawler()
 crawler.verbose=options.verbose
 crawler.set_concurrency_level(options.jobs)
 crawler.delay=options.delay
+crawler.use_asyncio=options.use_asyncio
+crawler.robots.ttl=options.robots_ttl
+crawler.dns.ttl=options.dns_ttl
+crawler.use_sitemaps=options.use_sitemaps
+if options.detect_traps:
+  crawler.traps=TrapDetector()
+if options.autothrottle:
+  crawler.scheduler=AdaptiveHostScheduler(options.delay, options.min_delay, options.max_delay, max(1, options.min_host_jobs), max(1, options.min_host_jobs, options.max_host_jobs))
 if options.crawltld:
   crawler.set_follow_mode(Crawler.F_TLD)
+  crawler.maxdomains=options.maxdomains
 else:
   crawler.set_follow_mode(Crawler.F_SAME_DOMAIN)
 crawler.set_timeout(20)
-if options.sizelimit != None:
-  unit=options.sizelimit[-1]
+def size_in_megabytes(value, option, description):
+  unit=value[-1]
   if unit == 'G':
-    crawler.sizelimit=float(options.sizelimit[:-1])*1000
+    return float(value[:-1])*1000
   elif unit == 'M':
-    crawler.sizelimit=float(options.sizelimit[:-1])
+    return float(value[:-1])
   elif unit == 'K':
-    crawler.sizelimit=float(options.sizelimit[:-1])/1000.0
+    return float(value[:-1])/1000.0
   else:
-    sys.stderr.write("The value of option -s (download size limit) has to be a number and a unit ('G' for gigabytes, 'M' for megabytes, or 'K' for kilobytes), for example: 10M or 150K\n")
+    sys.stderr.write("The value of option "+option+" ("+description+") has to be a number and a unit ('G' for gigabytes, 'M' for megabytes, or 'K' for kilobytes), for example: 10M or 150K\n")
     sys.exit(-1)
 
+if options.sizelimit != None:
+  crawler.sizelimit=size_in_megabytes(options.sizelimit, "-s", "download size limit")
+
+crawler.max_document_size=int(size_in_megabytes(options.maxdocsize, "--max-document-size", "maximum size of a document")*1000000)
+
 if options.timelimit != None:
   unit=options.timelimit[-1]
   if unit == 'h':
@@ -511,20 +2782,150 @@ if options.timelimit != None:
 if options.dump != None:
   crawler.dumpfile=options.dump
 
-if options.load != None:
-  sys.stderr.write("Restoring crawling from "+options.load+"\n")
-  crawler.load_status(pickle.load(open(options.load,'rb')))
+warcsize=int(size_in_megabytes(options.warcsize, "--warc-size", "size of the WARC files")*1000000)
+
+if options.previous != None:
+  crawler.validators=read_validators(options.previous)
+  sys.stderr.write("Loaded "+str(len(crawler.validators))+" URLs from the previous crawling\n")
+crawler.revisit_records=options.revisit_records
+
+def open_frontier(suffix=""):
+  # A database given with -l is the only one opened, so the tables of --frontier are not dropped when it is the same file
+  resume=options.load != None and SqliteFrontier.is_database(options.load+suffix)
+  if options.load != None:
+    sys.stderr.write("Restoring crawling from "+options.load+suffix+"\n")
+  if resume:
+    crawler.frontier=SqliteFrontier(options.load+suffix, resume=True, checkpoint_interval=options.checkpoint_interval)
+  elif options.frontier != None:
+    crawler.frontier=SqliteFrontier(options.frontier+suffix, checkpoint_interval=options.checkpoint_interval)
+  elif options.seen_error_rate != None:
+    crawler.frontier=MemoryFrontier(seen=BloomFilter(options.seen_error_rate))
+
+  if options.lang1 != None or options.lang2 != None:
+    crawler.set_languages([lang for lang in (options.lang1, options.lang2) if lang != None])
+  if options.detect_traps:
+    # The URLs that look like traps are demoted, so they have to be popped by priority; a status loaded below is
+    # reordered by set_status
+    crawler.frontier.prioritised=True
+
+  if options.load != None and not resume:
+    crawler.load_status(pickle.load(open(options.load+suffix,'rb')))
+
+def start_metrics(suffix="", offset=0):
+  if options.metrics == None and options.metrics_port == None:
+    return None
+  return MetricsReporter(crawler, options.metrics+suffix if options.metrics != None else None,
+    options.metrics_port+offset if options.metrics_port != None else None, options.metrics_interval)
+
+def crawl_shard(shard, url):
+  # Runs in a process of its own: the coordinator enforces -s
+  suffix="."+str(shard.index)
+  crawler.sizelimit=None
+  if crawler.dumpfile != None:
+    crawler.dumpfile+=suffix
+  open_frontier(suffix)
+  if options.warcprefix != None:
+    crawler.writer=WARCWriter(options.warcprefix+"-"+str(shard.index), warcsize)
+  else:
+    crawler.writer=WARCWriter(sink=lambda data: shard.results.put(("warc", data)))
+  metrics=start_metrics(suffix, shard.index)
+  crawler.run_shard(shard, url)
+  if not shard.idle:
+    crawler.save_status()
+  if metrics != None:
+    metrics.close()
+  crawler.frontier.close()
+  crawler.writer.close()
+  shard.results.put(("done", shard.index))
+
+def crawl_shards(url, processes):
+  context=multiprocessing.get_context("fork")
+  results=context.Queue()
+  stop=context.Event()
+  inboxes=[context.Queue() for i in range(processes)]
+  workers=[]
+  for i in range(processes):
+    worker=context.Process(target=crawl_shard, args=(Shard(i, processes, inboxes[i], results, stop), url))
+    worker.start()
+    workers.append(worker)
+  # Status files are saved by the crawling processes
+  crawler.dumpfile=None
+
+  forwarded=[0]*processes
+  status=[None]*processes
+  stopped=set()
+  closed=False
+  finished=set()
+  while len(finished) < processes:
+    ended=[i for i in range(processes) if workers[i].exitcode != None and i not in finished]
+    try:
+      message=results.get(timeout=0.5)
+    except queue.Empty:
+      message=None
+      for i in ended:
+        sys.stderr.write("Crawling process "+str(i)+" ended unexpectedly\n")
+        stopped.add(i)
+        finished.add(i)
+        stop.set()
+    if message != None:
+      if message[0] == "warc":
+        sys.stdout.buffer.write(message[1])
+      elif message[0] == "url":
+        owner=Shard.owner(message[1], processes)
+        inboxes[owner].put(message[1:])
+        forwarded[owner]+=1
+      elif message[0] == "status":
+        status[message[1]]=message[2:]
+      elif message[0] == "stopped":
+        stopped.add(message[1])
+      elif message[0] == "done":
+        finished.add(message[1])
+    if len(stopped) == processes and not closed:
+      # No more URLs can be sent: every process can save its frontier
+      for inbox in inboxes:
+        inbox.put(None)
+      closed=True
+    crawler.crawlsize=sum(s[2] for s in status if s != None)
+    if stop.is_set():
+      continue
+    if crawler.sizelimit != None and crawler.crawlsize > crawler.sizelimit:
+      crawler.interrupt=True
+    elif crawler.timelimit != None and time.time()-crawler.crawlstarts > crawler.timelimit:
+      crawler.interrupt=True
+    # The crawling is over when every process waits for URLs and all the URLs sent to it were received
+    if crawler.interrupt or all(status[i] != None and status[i][0] and status[i][1] == forwarded[i] for i in range(processes)):
+      stop.set()
+
+  for i in range(processes):
+    workers[i].join()
+    inboxes[i].cancel_join_thread()
+  sys.stdout.flush()
+
 if options.resumeett != None:
   for line in open(options.resumeett):
       print(line.rstrip("\n"))
+  sys.stdout.flush()
 
 #crawler.add_url_filter('\.(jpg|jpeg|gif|png|js|css|swf)$')
 signal.signal(signal.SIGTERM, crawler.termsighandler)
-crawler.init_crawling(options.URL)
-if options.crawltld:
-  while len(list(crawler.outerdomaintargets.keys())) > 0:
-    sys.stderr.write("Remaining "+str(len(list(crawler.outerdomaintargets.keys())))+" websites to to crawl\n")
-    crawler.keep_crawling()
+if options.processes > 1:
+  crawl_shards(options.URL, options.processes)
+else:
+  open_frontier()
+  if options.warcprefix != None:
+    crawler.writer=WARCWriter(options.warcprefix, warcsize)
+  else:
+    crawler.writer=WARCWriter()
+  metrics=start_metrics()
+  crawler.init_crawling(options.URL)
+  if options.crawltld:
+    while crawler.frontier.outer_domains() > 0 and not crawler.interrupt:
+      sys.stderr.write("Remaining "+str(crawler.frontier.outer_domains())+" websites to to crawl\n")
+      crawler.keep_crawling()
+  if metrics != None:
+    metrics.close()
+  crawler.frontier.close()
+  crawler.writer.close()
 
 if crawler.interrupt:
   if crawler.sizelimit != None and crawler.crawlsize > crawler.sizelimit:
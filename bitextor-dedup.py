@@ -6,15 +6,22 @@
 # 3. The output produced is:
 #    character_encoding     MIME    URL    content_base64
 #
+# With option --index, the documents seen are stored in a file, so those already seen in previous runs (for example,
+# in the crawls of other websites) are also discarded
+#
 
+import os
 import sys
-import hashlib
 import base64
+import binascii
 import argparse
+sys.path.append(os.path.dirname(os.path.abspath(__file__))+"/../share/bitextor/utils")
+from lettprocessing import DedupIndex
 
 
 oparser = argparse.ArgumentParser(description="Script that takes the output of bitextor-crawl2ett and removes duplicate files.")
 oparser.add_argument('ett', metavar='ETT', nargs='?', help='Output of the bitextor-crawl2ett script (in format ETT).', default=None)
+oparser.add_argument('--index', help='File with the index of the documents seen, which is created if it does not exist and is updated with the new documents; by default, the index is kept in memory and only the duplicates in the input are removed', dest='index', default=None)
 options = oparser.parse_args()
 
 if options.ett == None:
@@ -22,19 +29,22 @@ if options.ett == None:
 else:
   reader = open(options.ett,"r")
 
-seen_md5={}
-for i in reader:
-  fields = i.strip().split("\t")
-  try:
-    e = fields[4]
-    #We compute MD5 signature to compare files and detect duplicates
-    c = hashlib.md5()
-    c.update(e.encode("utf8"))
-    #checking for duplicate content (duplicates are discarded)
-    if c.hexdigest() in seen_md5:
-      sys.stderr.write("Repeated file:\t"+fields[2]+"\tfirst occurrence\t"+seen_md5[c.hexdigest()]+"\n")
-    else:
-      seen_md5[c.hexdigest()]=fields[2]
-      print("{0}\t{1}\t{2}\t{3}".format(fields[0].strip(),fields[1],fields[2],e))
-  except UnicodeDecodeError:
-    sys.stderr.write("File "+fields[2]+" produced a character encoding error")
+index = DedupIndex(options.index)
+try:
+  for i in reader:
+    fields = i.strip().split("\t")
+    try:
+      e = fields[4]
+      #We compute the digest of the content to compare files and detect duplicates
+      first = index.add(base64.b64decode(e), fields[2])
+      #checking for duplicate content (duplicates are discarded)
+      if first != None:
+        sys.stderr.write("Repeated file:\t"+fields[2]+"\tfirst occurrence\t"+first+"\n")
+      else:
+        print("{0}\t{1}\t{2}\t{3}".format(fields[0].strip(),fields[1],fields[2],e))
+    except UnicodeDecodeError:
+      sys.stderr.write("File "+fields[2]+" produced a character encoding error")
+    except binascii.Error:
+      sys.stderr.write("File "+fields[2]+" has a content that is not valid base64\n")
+finally:
+  index.close()
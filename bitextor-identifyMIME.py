@@ -6,14 +6,44 @@
 # 3. The output produced is:
 #    character_encoding     MIME    URL    content_base64
 #
+# With option -j, documents are processed by several worker processes, each one with its own libmagic handle; the
+# output keeps the order of the input
+#
 
+import os
 import sys
-import magic
 import base64
 import argparse
+import multiprocessing
+sys.path.append(os.path.dirname(os.path.abspath(__file__))+"/../share/bitextor/utils")
+from lettprocessing import open_magic, identify_mime, ordered_map
+
+def init_worker(trust_declared):
+  global m, trust_declared_charset
+  m=open_magic()
+  trust_declared_charset=trust_declared
+
+def identify(line):
+  """Returns the output line of a document, or None and the reason why it is discarded.
+  """
+  fields=line.strip().split("\t")
+  if len(fields)<2:
+    return None, "Wrong line: "+line.strip()+"\n"
+  url=fields[1]
+  content=fields[0]
+  #~Mime and encodign
+  try:
+    magicoutput, text = identify_mime(m, base64.b64decode(content), trust_declared_charset)
+  except LookupError as e:
+    return None, "Unknown character encoding in file "+url+": "+str(e)+"\n"
+  magicoutput.append(url)
+  magicoutput.append(base64.b64encode(text.encode("utf8")).decode("utf8"))
+  return "\t".join(magicoutput), None
 
 oparser = argparse.ArgumentParser(description="Script that takes the output of bitextor-crawl and adds to the list of fields the MIME type and the character encoding detected.")
 oparser.add_argument('crawl', metavar='CRAWL', nargs='?', help='Output of the bitextor-crawl script that provides a tab-separated list of documents, only containing two fields: the content of the document encoded with base64 and the URL.', default=None)
+oparser.add_argument("-j", "--jobs", help="Number of worker processes; by default, 1", dest="jobs", type=int, default=1)
+oparser.add_argument("--trust-declared-charset", help="Do not run libmagic on the HTML documents that are plain ASCII or declare UTF-8 in their <meta> tags and are valid UTF-8", dest="trust_declared", action="store_true")
 options = oparser.parse_args()
 
 if options.crawl == None:
@@ -21,22 +51,15 @@ if options.crawl == None:
 else:
   reader = open(options.crawl,"r")
 
-m=magic.open(magic.MAGIC_NONE)
-m.load()
-for line in reader:
-  fields=line.strip().split("\t")
-  if len(fields)>=2:
-    url=fields[1]
-    content=fields[0]
-    #~Mime and encodign
-    m.setflags(16|1024)
-    magicoutput=m.buffer(base64.b64decode(content)).split(" ")
-    magicoutput[0]=magicoutput[0][:-1]
-    magicoutput.append(url)
-    try:
-      magicoutput.append(base64.b64encode(base64.b64decode(content).decode(magicoutput[1].split("=")[1].replace("unknown-8bit","iso-8859-1").replace('us-ascii','iso-8859-1')).encode("utf8")).decode("utf8"))
-      print("\t".join(magicoutput))
-    except LookupError as e:
-      sys.stderr.write("Unknown character encoding in file "+url+": "+str(e)+"\n")
+if options.jobs > 1:
+  pool = multiprocessing.get_context("fork").Pool(options.jobs, init_worker, (options.trust_declared,))
+  results = ordered_map(pool, identify, reader, options.jobs)
+else:
+  init_worker(options.trust_declared)
+  results = map(identify, reader)
+
+for output, error in results:
+  if output != None:
+    print(output)
   else:
-    sys.stderr.write("Wrong line: "+line.strip()+"\n")
+    sys.stderr.write(error)
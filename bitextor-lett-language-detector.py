@@ -8,20 +8,50 @@
 #
 #
 
+import os
 import sys
 import base64
 from html.parser import HTMLParser
-import langid
 import argparse
 import socket
 import re
+import multiprocessing
+sys.path.append(os.path.dirname(os.path.abspath(__file__))+"/../share/bitextor/utils")
+from lettprocessing import identify_language, load_language_model, sample_text, ordered_map, cld2
+
+def detect(line):
+  """Returns the line of the document in LETT, or None if it has no text or it is not in one of the languages
+  accepted.
+  """
+  linefields=line.strip().split("\t")
+  #decoding the b64 original webpage
+  if len(linefields)>=5:
+    parsed_text=base64.b64decode(linefields[4]).decode("utf-8")
+    if len(parsed_text)>0:
+      #detecting language
+      lang = identify_language(sample_text(parsed_text, options.sample_size, options.sample_chunks), options.detector)
+      if len(langs)==0 or lang in langs:
+        linefields.insert(0,lang)
+        e = base64.b64encode(parsed_text.replace("\t", " ").encode("utf-8")).decode("utf8")
+        del linefields[-1]
+        linefields.append(e)
+        return "\t".join(linefields)
+  return None
 
 
 oparser = argparse.ArgumentParser(description="Script that reads the output of bitextor-webdir2ett and, for each line (lines correspond to files in de website) the language of the document is detected and this information is added to the information about the documents.")
 oparser.add_argument("ett_path", metavar="FILE", nargs="?", help="File containing the output of bitextor-webdir2ett (if undefined, the script reads from the standard input)", default=None)
 oparser.add_argument("-l", "--languages", help="List accepted languages represented as a comma separated language codes list", dest="langlist", default=None)
+oparser.add_argument("-j", "--jobs", help="Number of worker processes; by default, 1", dest="jobs", type=int, default=1)
+oparser.add_argument("--detector", help="Language detector: langid (default) or cld2, which is faster but requires the cld2-cffi or pycld2 module", dest="detector", choices=["langid", "cld2"], default="langid")
+oparser.add_argument("--sample-size", help="Maximum number of characters of every document used to detect its language; by default, the whole text is used", dest="sample_size", type=int, default=None)
+oparser.add_argument("--sample-chunks", help="Number of pieces, spread along the document, in which the characters of option --sample-size are taken; by default 1, that is, the beginning of the text", dest="sample_chunks", type=int, default=1)
 options = oparser.parse_args()
 
+if options.detector == "cld2" and cld2 == None:
+  sys.stderr.write("The cld2 language detector needs the cld2-cffi or the pycld2 Python module\n")
+  sys.exit(1)
+
 langs=[]
 if options.langlist != None:
   langs=options.langlist.strip().split(",")
@@ -32,17 +62,15 @@ else:
   reader = sys.stdin
 
 #Reading line by line from the standard output
-for line in reader:
-  linefields=line.strip().split("\t")
-  #decoding the b64 original webpage
-  if len(linefields)>=5:
-    parsed_text=base64.b64decode(linefields[4]).decode("utf-8")
-    if len(parsed_text)>0:
-      #detecting language
-      lang, conf = langid.classify(parsed_text)
-      if len(langs)==0 or lang in langs:
-        linefields.insert(0,lang)
-        e = base64.b64encode(parsed_text.replace("\t", " ").encode("utf-8")).decode("utf8")
-        del linefields[-1]
-        linefields.append(e)
-        print("\t".join(linefields))
+if options.jobs > 1:
+  # The model is loaded before starting the workers, so they share it
+  if options.detector == "langid":
+    load_language_model()
+  pool = multiprocessing.get_context("fork").Pool(options.jobs)
+  results = ordered_map(pool, detect, reader, options.jobs)
+else:
+  results = map(detect, reader)
+
+for result in results:
+  if result != None:
+    print(result)
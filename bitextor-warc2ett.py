@@ -6,5 +6,8 @@ import sys
 
 f = warc.WARCFile(fileobj=sys.stdin.buffer)
 for record in f:
+    # Pages that did not change since a previous crawling have no content
+    if record.type == 'revisit':
+        continue
     print(base64.b64encode(record.payload.read()).decode('utf8')+"\t"+record.url+"\t"+record.date)
 
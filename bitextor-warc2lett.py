@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+#
+# 1. This script reads a WARC file (for example, the output of bitextor-crawl) and runs on it, in a single process,
+#    every step of bitextor-crawl2ett and bitextor-ett2lett:
+#    - the MIME type and the character encoding of every document are identified and it is converted to UTF-8
+#    - the HTML is normalised and, unless option -b is used, cleaned with boilerpipe
+#    - duplicate documents are discarded (reported through STDERR), also those seen in previous runs with option --dedup-index
+#    - the text of every document is extracted and its language is detected
+# 2. Documents are processed by a pool of worker processes; they are only encoded with base64 for the output,
+#    instead of being decoded and encoded again in every step of the pipeline
+# 3. The output produced is the same as that of bitextor-crawl2ett | bitextor-ett2lett (LETT):
+#    language	mimetype	encoding	url	html_content(base_64)	text(base_64)
+#
+
+import os
+import sys
+import base64
+import argparse
+import subprocess
+import multiprocessing
+from threading import Thread
+import warc
+from lxml import etree
+sys.path.append(os.path.dirname(os.path.abspath(__file__))+"/../share/bitextor/utils")
+from lettprocessing import open_magic, identify_mime, clean_html, html_text, identify_language, load_language_model, sample_text, ordered_map, DedupIndex, cld2
+
+def init_worker():
+  global m
+  m=open_magic()
+
+def normalise(record):
+  """Steps of bitextor-crawl2ett before boilerpipe. Returns the fields of the document in ETT (MIME type,
+  character encoding, URL and normalised HTML encoded with base64), or None and the reason why it is discarded.
+  """
+  url, content = record
+  try:
+    magicoutput, text = identify_mime(m, content, options.trust_declared)
+  except LookupError as e:
+    return None, "Unknown character encoding in file "+url+": "+str(e)+"\n"
+  except UnicodeDecodeError as e:
+    return None, "File "+url+" produced a character encoding error: "+str(e)+"\n"
+  # Errors of lxml cannot be sent back from the workers, so they are reported here
+  try:
+    html=clean_html(text)
+  except (etree.LxmlError, ValueError) as e:
+    return None, "File "+url+" could not be parsed: "+str(e)+"\n"
+  return [magicoutput[0], magicoutput[1], url, base64.b64encode(html.encode()).decode("utf8")], None
+
+def ett2lett(fields):
+  """Steps of bitextor-ett2lett. Returns the line of the document in LETT, or None if it has no text or it is not
+  in one of the languages accepted, and the reason why it is discarded if it is an error.
+  """
+  try:
+    text=html_text(base64.b64decode(fields[3]).decode("utf8"))
+  except (etree.LxmlError, ValueError) as e:
+    return None, "File "+fields[2]+" could not be parsed: "+str(e)+"\n"
+  if len(text)==0:
+    return None, None
+  lang=identify_language(sample_text(text, options.sample_size, options.sample_chunks), options.detector)
+  if len(langs)>0 and lang not in langs:
+    return None, None
+  return "\t".join([lang]+fields+[base64.b64encode(text.replace("\t", " ").encode("utf-8")).decode("utf8")]), None
+
+def records(reader):
+  for record in reader:
+    # Pages that did not change since a previous crawling have no content
+    if record.type == 'revisit':
+      continue
+    yield record.url, record.payload.read()
+
+def normalised(pool, reader):
+  for fields, error in ordered_map(pool, normalise, records(reader), options.jobs):
+    if fields == None:
+      sys.stderr.write(error)
+    else:
+      yield fields
+
+def deduplicated(documents):
+  for fields in documents:
+    first=index.add(base64.b64decode(fields[3]), fields[2])
+    if first != None:
+      sys.stderr.write("Repeated file:\t"+fields[2]+"\tfirst occurrence\t"+first+"\n")
+      continue
+    if ett != None:
+      ett.write("\t".join(fields)+"\n")
+    yield fields
+
+def feed_boilerpipe(pool, reader, boilerpipe, errors):
+  # boilerpipe is always closed, so the main thread does not wait for its output forever; an error is raised
+  # again by the main thread
+  try:
+    for fields in normalised(pool, reader):
+      # boilerpipe cleans the fifth field; the fourth one, the original document, is not needed
+      boilerpipe.stdin.write("\t".join(fields[:3]+["", fields[3]])+"\n")
+  except BaseException as e:
+    errors.append(e)
+  finally:
+    boilerpipe.stdin.close()
+
+def boilerpipe_output(boilerpipe):
+  for line in boilerpipe.stdout:
+    fields=line.strip().split("\t")
+    if len(fields) == 5:
+      yield [fields[0].strip(), fields[1], fields[2], fields[4]]
+
+oparser = argparse.ArgumentParser(description="Script that reads a WARC file, such as the output of bitextor-crawl, and produces the same LETT file as bitextor-crawl2ett and bitextor-ett2lett, running every step in a pool of worker processes instead of a pipeline of scripts.")
+oparser.add_argument('warc', metavar='WARC', nargs='?', help='WARC file with the documents crawled (if undefined, the script reads from the standard input)', default=None)
+oparser.add_argument("-l", "--languages", help="List accepted languages represented as a comma separated language codes list", dest="langlist", default=None)
+oparser.add_argument("-b", help="Do not clean the HTML of the documents with boilerpipe", dest="noboilerpipe", action="store_true")
+oparser.add_argument("-j", "--jobs", help="Number of worker processes; by default, the number of CPUs", dest="jobs", type=int, default=multiprocessing.cpu_count())
+oparser.add_argument("--trust-declared-charset", help="Do not run libmagic on the HTML documents that are plain ASCII or declare UTF-8 in their <meta> tags and are valid UTF-8", dest="trust_declared", action="store_true")
+oparser.add_argument("--detector", help="Language detector: langid (default) or cld2, which is faster but requires the cld2-cffi or pycld2 module", dest="detector", choices=["langid", "cld2"], default="langid")
+oparser.add_argument("--sample-size", help="Maximum number of characters of every document used to detect its language; by default, the whole text is used", dest="sample_size", type=int, default=None)
+oparser.add_argument("--sample-chunks", help="Number of pieces, spread along the document, in which the characters of option --sample-size are taken; by default 1, that is, the beginning of the text", dest="sample_chunks", type=int, default=1)
+oparser.add_argument("--dedup-index", help="File with the index of the documents seen, as in bitextor-dedup, so those already seen in previous runs are also discarded", dest="dedup_index", default=None)
+oparser.add_argument("--ett", help="File where the documents are also written in ETT, as bitextor-crawl2ett would do", dest="ett", default=None)
+options = oparser.parse_args()
+
+if options.detector == "cld2" and cld2 == None:
+  sys.stderr.write("The cld2 language detector needs the cld2-cffi or the pycld2 Python module\n")
+  sys.exit(1)
+
+langs=[]
+if options.langlist != None:
+  langs=options.langlist.strip().split(",")
+
+if options.warc == None:
+  reader = warc.WARCFile(fileobj=sys.stdin.buffer)
+else:
+  reader = warc.WARCFile(filename=options.warc)
+
+ett = None
+if options.ett != None:
+  ett = open(options.ett, "w")
+
+index = DedupIndex(options.dedup_index)
+# The model of langid is loaded before starting the workers, so they share it
+if options.detector == "langid":
+  load_language_model()
+pool = multiprocessing.get_context("fork").Pool(options.jobs, init_worker)
+try:
+  if options.noboilerpipe:
+    documents = normalised(pool, reader)
+  else:
+    # boilerpipe runs in Java, so the documents go through it as in bitextor-crawl2ett
+    try:
+      boilerpipe = subprocess.Popen(["java", "-jar", os.path.dirname(os.path.abspath(__file__))+"/../share/java/piped-boilerpipe.jar"],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True, encoding="utf8")
+    except OSError as e:
+      sys.stderr.write("boilerpipe could not be run ("+str(e)+"); use option -b to skip it\n")
+      sys.exit(1)
+    feeder_errors = []
+    feeder = Thread(target=feed_boilerpipe, args=(pool, reader, boilerpipe, feeder_errors))
+    feeder.daemon = True
+    feeder.start()
+    documents = boilerpipe_output(boilerpipe)
+  # Duplicates are discarded before extracting their text
+  for result, error in ordered_map(pool, ett2lett, deduplicated(documents), options.jobs):
+    if result != None:
+      print(result)
+    elif error != None:
+      sys.stderr.write(error)
+  if not options.noboilerpipe:
+    feeder.join()
+    boilerpipe.wait()
+    if len(feeder_errors) > 0:
+      raise feeder_errors[0]
+finally:
+  pool.terminate()
+  index.close()
+  if ett != None:
+    ett.close()
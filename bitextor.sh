@@ -23,7 +23,6 @@ INPUTMODE=0
 DEDUPRAM=""
 DEDUP=""
 CRAWLLOG=/dev/null
-CRAWL2ETTLOG=/dev/null
 ETT2LETTLOG=/dev/stderr
 WEBDIR2ETTLOG=/dev/null
 LETT2LETTRLOG=/dev/stderr
@@ -74,6 +73,7 @@ DEFERREDCOLUMN=""
 DEFERRED=""
 KEEPSEG=""
 IGNOREBOILER=""
+DEDUPINDEX=""
 USEHTTRACK=0
 CONFIGFILEOPTIONS=""
 CONFIGFILE=""
@@ -209,6 +209,9 @@ exit_program()
   echo "                    all the segment pairs identified, which can be time and disk consuming; to use a data structure in RAM, use option --dedup-ram."
   echo "  --dedup-ram       this option performs the same way than --dedup, but instead of sorting the segments, it stores all of them in a data structure in"
   echo "                    RAM memory for deduplication instead of sorting them."
+  echo "  --dedup-index FILE"
+  echo "                    discard the web pages already found in FILE, an index of the pages processed in previous runs of Bitextor,"
+  echo "                    even for other websites. FILE is created if it does not exist and it is updated with the new pages."
 
   exit 1
 }
@@ -262,9 +265,13 @@ run_bitextor(){
   if [ "$CRAWLINGDATACONTINUE" != "" ]; then
       CONTINUEARGS="$CONTINUEARGS -e $CRAWLINGDATACONTINUE"
   fi
+  LANGARGS=""
+  if [ "$LANG1" != "" -a "$LANG2" != "" ]; then
+      LANGARGS="--lang1 $LANG1 --lang2 $LANG2"
+  fi
 
   if [ "$USEHTTRACK" == "0" ]; then #HTTRACK not used
-    "$(dirname "$0")"/bitextor-crawl $TLD_CRAWL $URL $SIZELIMIT $TIMELIMIT $JOBS $TIMEOUT $DUMPARGS $CONTINUEARGS 2> $CRAWLLOG | tee $CRAWLOUT > $tmpcrawl &
+    "$(dirname "$0")"/bitextor-crawl $TLD_CRAWL $URL $SIZELIMIT $TIMELIMIT $JOBS $TIMEOUT $DUMPARGS $CONTINUEARGS $LANGARGS 2> $CRAWLLOG | tee $CRAWLOUT > $tmpcrawl &
     crawl_pid=$(jobs -p)
     trap "trapsigint $crawl_pid" SIGINT
     trap "trapsigint $crawl_pid" SIGUSR1
@@ -283,8 +290,11 @@ run_bitextor(){
     fi
   fi
   if [ "$ONLYCRAWL" == "" ]; then
-    "$(dirname "$0")"/bitextor-crawl2ett $IGNOREBOILER < $tmpcrawl 2> $CRAWL2ETTLOG | tee $CRAWL2ETTOUT | \
-    "$(dirname "$0")"/bitextor-ett2lett -l ${LANG1},$LANG2 2> $ETT2LETTLOG | tee $ETT2LETTOUT > $LETT &
+    WARC2LETTETT=""
+    if [ "$CRAWL2ETTOUT" != "" ]; then
+      WARC2LETTETT="--ett $CRAWL2ETTOUT"
+    fi
+    "$(dirname "$0")"/bitextor-warc2lett $IGNOREBOILER $DEDUPINDEX $WARC2LETTETT -l ${LANG1},$LANG2 < $tmpcrawl 2> $ETT2LETTLOG | tee $ETT2LETTOUT > $LETT &
   fi
   
   if [ "$DONOTPIPELETT" != "" ]; then
@@ -520,7 +530,7 @@ align_documents_and_segments(){
 trap '' SIGINT
 
 OLDARGS="$@"
-ARGS=$(getopt -o xaWDBHf:q:m:v:b:l:u:U:d:D:L:D:e:E:I:t:O:M:N:T:s:j:c:p:C:R:F: -l tmx-output,only-document-alignment,elrc-quality-metrics,crawl-tld,ignore-boilerpipe-cleaning,httrack,url:,url-list:,ett:,lett:,logs-dir:,lettr:,intermediate-files-dir:,num-accepted-candidates:,vocabulary:,tmp-dir:,num-threads:,sl-morphological-analyser:,tl-morphological-analyser:,output:,doc-alignment-score-threshold:,maximum-wrong-alignments:,seg-alignment-score-threshold:,continue-crawling-file:,reuse-crawling-file:,size-limit:,time-limit:,write-crawling-file:,timeout-crawl:,dirname:,config-file:,aligned-document-input:,aligned-sentences-input:,only-crawl,only-lett,bicleaner:,zipporah:,filter-bicleaner:,filter-zipporah:,paracrawl-aligner-command:,filter-with-elrc,deferred,keep-orig-seg,dedup,dedup-ram -- "$@")
+ARGS=$(getopt -o xaWDBHf:q:m:v:b:l:u:U:d:D:L:D:e:E:I:t:O:M:N:T:s:j:c:p:C:R:F: -l tmx-output,only-document-alignment,elrc-quality-metrics,crawl-tld,ignore-boilerpipe-cleaning,httrack,url:,url-list:,ett:,lett:,logs-dir:,lettr:,intermediate-files-dir:,num-accepted-candidates:,vocabulary:,tmp-dir:,num-threads:,sl-morphological-analyser:,tl-morphological-analyser:,output:,doc-alignment-score-threshold:,maximum-wrong-alignments:,seg-alignment-score-threshold:,continue-crawling-file:,reuse-crawling-file:,size-limit:,time-limit:,write-crawling-file:,timeout-crawl:,dirname:,config-file:,aligned-document-input:,aligned-sentences-input:,only-crawl,only-lett,bicleaner:,zipporah:,filter-bicleaner:,filter-zipporah:,paracrawl-aligner-command:,filter-with-elrc,deferred,keep-orig-seg,dedup,dedup-ram,dedup-index: -- "$@")
 
 eval set -- $ARGS
 for i
@@ -535,7 +545,7 @@ do
   shift
 done
 
-ARGS=$(getopt -o xaWDBHf:q:m:v:b:l:u:U:d:D:L:D:e:E:I:t:O:M:N:T:s:j:c:p:C:R:F: -l tmx-output,only-document-alignment,elrc-quality-metrics,crawl-tld,ignore-boilerpipe-cleaning,httrack,url:,url-list:,ett:,lett:,logs-dir:,lettr:,intermediate-files-dir:,num-accepted-candidates:,vocabulary:,tmp-dir:,num-threads:,sl-morphological-analyser:,tl-morphological-analyser:,output:,doc-alignment-score-threshold:,maximum-wrong-alignments:,seg-alignment-score-threshold:,continue-crawling-file:,reuse-crawling-file:,size-limit:,time-limit:,write-crawling-file:,timeout-crawl:,dirname:,config-file:,aligned-document-input:,aligned-sentences-input:,only-crawl,only-lett,bicleaner:,zipporah:,filter-bicleaner:,filter-zipporah:,paracrawl-aligner-command:,filter-with-elrc,deferred,keep-orig-seg,dedup,dedup-ram -- $CONFIGFILEOPTIONS $OLDARGS)
+ARGS=$(getopt -o xaWDBHf:q:m:v:b:l:u:U:d:D:L:D:e:E:I:t:O:M:N:T:s:j:c:p:C:R:F: -l tmx-output,only-document-alignment,elrc-quality-metrics,crawl-tld,ignore-boilerpipe-cleaning,httrack,url:,url-list:,ett:,lett:,logs-dir:,lettr:,intermediate-files-dir:,num-accepted-candidates:,vocabulary:,tmp-dir:,num-threads:,sl-morphological-analyser:,tl-morphological-analyser:,output:,doc-alignment-score-threshold:,maximum-wrong-alignments:,seg-alignment-score-threshold:,continue-crawling-file:,reuse-crawling-file:,size-limit:,time-limit:,write-crawling-file:,timeout-crawl:,dirname:,config-file:,aligned-document-input:,aligned-sentences-input:,only-crawl,only-lett,bicleaner:,zipporah:,filter-bicleaner:,filter-zipporah:,paracrawl-aligner-command:,filter-with-elrc,deferred,keep-orig-seg,dedup,dedup-ram,dedup-index: -- $CONFIGFILEOPTIONS $OLDARGS)
 eval set -- $ARGS
 for i
 do
@@ -581,7 +591,6 @@ do
       LOGDIR=$1
       mkdir -p $LOGDIR
       CRAWLLOG=$LOGDIR/bitextorcrawl.log
-      CRAWL2ETTLOG=$LOGDIR/bitextorcrawl2ett.log
       ETT2LETTLOG=$LOGDIR/bitextorett2lett.log
       WEBDIR2ETTLOG=$LOGDIR/bitextorwebdir2ett.log
       LETT2LETTRLOG=$LOGDIR/bitextorlett2lettr.log
@@ -804,6 +813,11 @@ do
       FORMAT="TMX"
       DEDUP=1
       ;;
+    --dedup-index)
+      shift
+      DEDUPINDEX="--dedup-index $1"
+      shift
+      ;;
     --dedup-ram)
       shift
       FORMAT="TMX"
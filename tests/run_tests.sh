@@ -0,0 +1,48 @@
+#!/bin/bash
+
+# Crawls a website of several hosts, served locally on the loopback addresses
+# 127.N.0.1 (all of them in the same "TLD", 1), with option -D and
+# --parallel-domains, with the threaded and the asyncio engines; every page of
+# every host has to be downloaded
+
+mydir=`dirname $0`
+HOSTS=8
+PAGES=5
+
+if [ -d "${mydir}/tmp" ]; then
+  rm -R "${mydir}/tmp"
+fi
+
+mkdir -p ${mydir}/tmp
+
+PORT=$(python3 -c 'import socket; s=socket.socket(); s.bind(("127.0.0.1", 0)); print(s.getsockname()[1])')
+SERVERS=""
+for n in $(seq 0 $((HOSTS-1))); do
+  site=${mydir}/tmp/site$n
+  mkdir -p $site
+  echo "<html><body>host $n <a href=\"p1.html\">1</a> <a href=\"p2.html\">2</a> <a href=\"http://127.$(( (n+1) % HOSTS )).0.1:$PORT/\">next</a></body></html>" > $site/index.html
+  for p in $(seq 1 $((PAGES-1))); do
+    echo "<html><body>host $n page $p <a href=\"p$(( p % (PAGES-1) + 1 )).html\">next</a></body></html>" > $site/p$p.html
+  done
+  python3 -m http.server $PORT --bind 127.$n.0.1 --directory $site > /dev/null 2>&1 &
+  SERVERS="$SERVERS $!"
+done
+trap "kill $SERVERS 2> /dev/null" EXIT
+sleep 1
+
+echo "-------------------"
+
+for engine in "" "--async"; do
+  timeout 300 python3 ${mydir}/../bitextor-crawl.py -D --parallel-domains 4 -T 0 $engine http://127.0.0.1:$PORT/ > ${mydir}/tmp/crawl.warc 2> ${mydir}/tmp/crawl.log
+  RES=$(grep -ac "WARC-Type: response" ${mydir}/tmp/crawl.warc)
+  if [ ${RES} -ne $((HOSTS*PAGES)) ]; then
+    echo "Test Failed"
+    echo "bitextor-crawl -D --parallel-domains 4 $engine downloaded ${RES} pages instead of $((HOSTS*PAGES))"
+    exit 1
+  fi
+done
+echo "Test OK"
+
+if [ -d "${mydir}/tmp" ]; then
+  rm -R "${mydir}/tmp"
+fi
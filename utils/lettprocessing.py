@@ -0,0 +1,260 @@
+#
+# Processing of the documents of a crawl on their way from a WARC file to a
+# LETT file. It is shared by the scripts of every step (bitextor-identifyMIME,
+# bitextor-get-html-text and bitextor-lett-language-detector) and by
+# bitextor-warc2lett, which runs all of them in a single process, so both ways
+# produce the same output.
+#
+
+import re
+import hashlib
+import sqlite3
+import collections
+import magic
+import html5lib
+import ftfy
+import langid
+from lxml import etree
+from lxml.html.clean import Cleaner
+
+# cld2 is an optional, faster, language detector, either from cld2-cffi or from pycld2
+try:
+  import cld2
+  CLD2_OPTIONS={"useFullLangTables": True}
+except ImportError:
+  try:
+    import pycld2 as cld2
+    CLD2_OPTIONS={}
+  except ImportError:
+    cld2=None
+
+# Documents sent to a worker at a time by ordered_map
+BATCH_SIZE=16
+
+# An HTML document, possibly after some comments, and the charset declared in its <meta> tags
+HTML_RX=re.compile(rb'\s*(?:<!--.*?-->\s*)*<(?:!doctype\s+html|html|head)\b', re.I|re.S)
+META_CHARSET_RX=re.compile(rb'<meta\s[^>]*?charset\s*=\s*["\']?\s*([a-z0-9_.:-]+)', re.I)
+# Control bytes; libmagic reports as binary the documents with most of them, so those are left to it
+BINARY_RX=re.compile(rb'[\x00-\x08\x0e-\x1f\x7f]')
+
+def open_magic():
+  """Returns a libmagic handle that identifies MIME types and character encodings.
+  """
+  m=magic.open(magic.MAGIC_NONE)
+  m.load()
+  m.setflags(magic.MAGIC_MIME_TYPE|magic.MAGIC_MIME_ENCODING)
+  return m
+
+def declared_mime(content):
+  """Returns the MIME type and the character encoding of an HTML document, in the same way as libmagic, when they
+  can be trusted without running it: the document has no control bytes and it is plain ASCII, or its <meta> tags
+  declare UTF-8 and it is valid UTF-8. Otherwise, None is returned.
+  """
+  if HTML_RX.match(content) == None or BINARY_RX.search(content) != None:
+    return None
+  if content.isascii():
+    return ["text/html", "charset=us-ascii"]
+  declared=META_CHARSET_RX.search(content, 0, 4096)
+  if declared == None or declared.group(1).lower() not in (b"utf-8", b"utf8"):
+    return None
+  try:
+    content.decode("utf-8")
+  except UnicodeDecodeError:
+    return None
+  return ["text/html", "charset=utf-8"]
+
+def identify_mime(m, content, trust_declared=False):
+  """Returns the MIME type and the character encoding detected by libmagic for the bytes of a document (as a list
+  such as ['text/html', 'charset=utf-8']) and the document decoded with that encoding. If trust_declared is set,
+  libmagic is skipped for the documents whose encoding is known (see declared_mime). LookupError is raised if the
+  encoding is unknown.
+  """
+  magicoutput=declared_mime(content) if trust_declared else None
+  if magicoutput == None:
+    magicoutput=m.buffer(content).split(" ")
+    magicoutput[0]=magicoutput[0][:-1]
+  text=content.decode(magicoutput[1].split("=")[1].replace("unknown-8bit","iso-8859-1").replace('us-ascii','iso-8859-1'))
+  return magicoutput, text
+
+# Characters that ftfy.fix_text may remove or replace in plain ASCII text
+FTFY_CONTROL_RX=re.compile('[\x00-\x08\x0b-\x1f\x7f]')
+
+def fix_text(text):
+  """Same as ftfy.fix_text, which is skipped for the documents it would not change: plain ASCII text cannot contain
+  mojibake and, if it starts with a tag and has no control characters, ftfy does not unescape its entities or
+  change its line breaks.
+  """
+  if text.isascii() and text.startswith("<") and FTFY_CONTROL_RX.search(text) == None:
+    return text
+  return ftfy.fix_text(text)
+
+def clean_html(html):
+  """Returns the HTML of a document cleaned and normalised as XHTML, with no
+  tabs, as it is given to boilerpipe.
+  """
+  document = html5lib.parse(fix_text(Cleaner(style=True, links=True, add_nofollow=True,page_structure=False, safe_attrs_only=False).clean_html(html)),treebuilder="lxml",namespaceHTMLElements=False)
+  tree=etree.tostring(document)
+  return tree.decode("utf8").replace("\t"," ")
+
+class TextTarget(object):
+  """Target of the lxml HTML parser that collects the text of a document as it is parsed, with no tree built, in the
+  same way as BeautifulSoup.get_text: the strings are joined from a list, those with only whitespace are reduced to
+  a space or a newline (except in <pre> and <textarea>), and those in scripts, styles, images, templates and ruby
+  annotations, comments, processing instructions and doctypes are left out.
+  """
+  SKIPPED_TAGS={"script", "style", "img", "template", "rp", "rt"}
+  PRESERVED_TAGS={"pre", "textarea"}
+  WHITESPACE="\x20\x0a\x09\x0c\x0d"
+
+  def __init__(self):
+    self.strings=[]
+    self.pending=[]
+    self.skipped=0
+    self.preserved=0
+
+  def end_data(self):
+    if len(self.pending) > 0:
+      string="".join(self.pending)
+      self.pending=[]
+      if self.skipped == 0:
+        if self.preserved == 0 and len(string.strip(self.WHITESPACE)) == 0:
+          string="\n" if "\n" in string else " "
+        self.strings.append(string)
+
+  def start(self, tag, attrib):
+    self.end_data()
+    if tag in self.SKIPPED_TAGS:
+      self.skipped+=1
+    if tag in self.PRESERVED_TAGS:
+      self.preserved+=1
+
+  def end(self, tag):
+    self.end_data()
+    if tag in self.SKIPPED_TAGS:
+      self.skipped-=1
+    if tag in self.PRESERVED_TAGS:
+      self.preserved-=1
+
+  def data(self, data):
+    self.pending.append(data)
+
+  def comment(self, text):
+    self.end_data()
+
+  def pi(self, target, data=None):
+    self.end_data()
+
+  def doctype(self, *args):
+    self.end_data()
+
+  def close(self):
+    self.end_data()
+    return "".join(self.strings)
+
+def html_text(html):
+  """Returns the plain text of a document, without scripts, styles or images.
+  """
+  parser = etree.HTMLParser(target=TextTarget())
+  parser.feed(html)
+  text = parser.close()
+  return re.sub(r"\n+","\n",re.sub(r" *\n *","\n",re.sub(r" +"," ",re.sub(r"\r","", text))))
+
+# Characters that cld2 does not accept
+CLD2_INVALID_RX=re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\x7f-\x9f\ud800-\udfff\ufdd0-\ufdef\ufffe\uffff]')
+
+def load_language_model():
+  """Loads the model of langid, which is otherwise loaded on the first document; when it is loaded before
+  starting worker processes, they share it.
+  """
+  langid.langid.load_model()
+
+def sample_text(text, size, chunks=1):
+  """Returns up to size characters of a text: its beginning or, if chunks is greater than 1, as many pieces taken
+  at regular intervals along the whole text.
+  """
+  if size == None or len(text) <= size:
+    return text
+  chunks=min(chunks, size)
+  if chunks <= 1:
+    return text[:size]
+  length=size//chunks
+  step=(len(text)-length)//(chunks-1)
+  return "\n".join(text[i*step:i*step+length] for i in range(chunks))
+
+def identify_language(text, detector="langid"):
+  """Returns the code of the language of a text, detected with langid or with cld2 (as in
+  TextSanitizer.guess_lang_from_data). If cld2 cannot detect it reliably, "un" is returned.
+  """
+  if detector == "cld2":
+    reliable, text_bytes, detected_languages = cld2.detect(CLD2_INVALID_RX.sub(" ", text).encode("utf-8"),
+      isPlainText=True, bestEffort=True, **CLD2_OPTIONS)
+    if not reliable:
+      return "un"
+    return detected_languages[0][1]
+  lang, conf = langid.classify(text)
+  return lang
+
+def run_batch(args):
+  function, batch = args
+  return [function(item) for item in batch]
+
+def ordered_map(pool, function, items, jobs):
+  """Same as Pool.imap, but items are sent to the workers in batches and only a few batches are read ahead of the
+  results consumed, so a large input is never loaded in memory as a whole.
+  """
+  pending=collections.deque()
+  batch=[]
+  for item in items:
+    batch.append(item)
+    if len(batch) == BATCH_SIZE:
+      pending.append(pool.apply_async(run_batch, ((function, batch),)))
+      batch=[]
+      if len(pending) > 4*jobs:
+        yield from pending.popleft().get()
+  if len(batch) > 0:
+    pending.append(pool.apply_async(run_batch, ((function, batch),)))
+  while len(pending) > 0:
+    yield from pending.popleft().get()
+
+class DedupIndex(object):
+  """Index of the documents already seen, identified by the MD5 digest of their content. By default it is kept in
+  memory; if a path is given, it is stored in an SQLite database, which is read through mmap and only keeps a small
+  cache in memory, so the memory used does not grow with the number of documents and the index can be shared by
+  the crawls of several websites. Changes are committed every commit_interval documents.
+  """
+  def __init__(self, path=None, commit_interval=10000):
+    self.path = path
+    self.seen = {}
+    self.db = None
+    if path != None:
+      self.commit_interval = commit_interval
+      self.pending = 0
+      self.db = sqlite3.connect(path)
+      self.db.execute('PRAGMA journal_mode=WAL')
+      self.db.execute('PRAGMA synchronous=NORMAL')
+      # SQLite limits it to the maximum size it was built with
+      self.db.execute('PRAGMA mmap_size=%d' % (1<<40))
+      self.db.execute('CREATE TABLE IF NOT EXISTS documents (digest BLOB PRIMARY KEY, url TEXT NOT NULL) WITHOUT ROWID')
+      self.db.commit()
+
+  def add(self, content, url):
+    """Adds a document to the index. Returns None if it was not seen before, or the URL of its first occurrence.
+    """
+    digest = hashlib.md5(content).digest()
+    if self.db == None:
+      if digest in self.seen:
+        return self.seen[digest]
+      self.seen[digest] = url
+      return None
+    if self.db.execute('INSERT OR IGNORE INTO documents (digest, url) VALUES (?, ?)', (digest, url)).rowcount == 1:
+      self.pending += 1
+      if self.pending >= self.commit_interval:
+        self.db.commit()
+        self.pending = 0
+      return None
+    return self.db.execute('SELECT url FROM documents WHERE digest = ?', (digest,)).fetchone()[0]
+
+  def close(self):
+    if self.db != None:
+      self.db.commit()
+      self.db.close()